@@ -0,0 +1,179 @@
+"""Benchmark the indicator paths on synthetic prices
+
+Runs offline with an in-memory stand-in for Mongo and reports symbol-days
+per second for each path. Correctness against scalar reference loops is
+covered by tests/test_indicators.py.
+
+Usage: python benchmark_indicators.py [--sizes N ...] [--days N] [--seed N]
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from random import Random
+from time import perf_counter
+from typing import Callable
+
+import numpy as np
+
+from data.indicators import compute_indicators
+from data.tracked_asset import INITIAL_DATA_POINTS, TrackedAsset
+
+UNIVERSE_SIZES = (1, 10, 100, 1000, 10000)
+DAYS = 500
+FIRST_DATE = datetime(2015, 1, 1)
+
+
+class StubCollection:
+    """Just enough of a pymongo Collection for TrackedAsset writes"""
+    def __init__(self, name: str):
+        self.name = name
+        self.documents = {}
+
+    def bulk_write(self, requests: list, ordered: bool = True) -> None:
+        """Apply the ReplaceOne upserts that storage.replace_many sends"""
+        for request in requests:
+            self.insert_one(document=request._doc)
+
+    def create_index(self, keys, **kwargs) -> None:
+        pass
+
+    def index_information(self) -> dict:
+        return {}
+
+    def insert_one(self, document: dict) -> None:
+        self.documents[(document['symbol'], document['date'])] = dict(
+            document)
+
+    def update_one(self, filter: dict, update: dict) -> None:
+        # Per-symbol collections are named after the symbol
+        key = (filter.get('symbol', self.name), filter['date'])
+        self.documents[key].update(update['$set'])
+
+
+class StubDatabase:
+    def __init__(self):
+        self.collections = {}
+
+    def get_collection(self, name: str) -> StubCollection:
+        if name not in self.collections:
+            self.collections[name] = StubCollection(name=name)
+        return self.collections[name]
+
+
+class StubClient:
+    def __init__(self):
+        self.databases = {}
+
+    def documents(self) -> dict[tuple, dict]:
+        """Every stored document keyed by (symbol, date)"""
+        return {key: document
+                for database in self.databases.values()
+                for collection in database.collections.values()
+                for key, document in collection.documents.items()}
+
+    def get_database(self, name: str) -> StubDatabase:
+        if name not in self.databases:
+            self.databases[name] = StubDatabase()
+        return self.databases[name]
+
+
+def measure(label: str, symbols: int, symbol_days: int,
+            run: Callable[[], None]) -> None:
+    started = perf_counter()
+    run()
+    elapsed = perf_counter() - started
+    print(label.ljust(24) + repr(symbols).rjust(8)
+          + repr(symbol_days).rjust(12) + '{:.3f}'.format(elapsed).rjust(10)
+          + '{:,.0f}'.format(symbol_days / elapsed).rjust(16))
+
+
+def random_walk(random: Random, days: int) -> list[float]:
+    prices = [random.uniform(5, 500)]
+    for _ in range(days - 1):
+        prices.append(max(0.01, prices[-1] * (1 + random.gauss(0, 0.02))))
+    return prices
+
+
+def run_benchmarks(random: Random, sizes: list[int], days: int) -> None:
+    """Time every path and print symbol-days per second"""
+    dates = trading_dates(days=days)
+    print('path'.ljust(24) + 'symbols'.rjust(8) + 'symbol-days'.rjust(12)
+          + 'seconds'.rjust(10) + 'symbol-days/s'.rjust(16))
+    for size in sizes:
+        universe = [random_walk(random=random, days=days)
+                    for _ in range(size)]
+        symbol_days = size * days
+
+        def batch() -> None:
+            compute_indicators(closes=np.array(universe))
+
+        def build() -> None:
+            for prices in universe:
+                TrackedAsset(symbol='X', date=dates[-1], close=prices[-1]
+                             ).build_history(prices=prices, dates=dates)
+
+        def insert() -> None:
+            mongo_client = StubClient()
+            for number, prices in enumerate(universe):
+                TrackedAsset(symbol='X' + repr(number), date=dates[-1],
+                             close=prices[-1]).calculate_and_insert(
+                    prices=prices, dates=dates, mongo_client=mongo_client)
+
+        def calculate() -> None:
+            mongo_client = StubClient()
+            for number, prices in enumerate(universe):
+                asset = TrackedAsset(symbol='X' + repr(number),
+                                     date=dates[-1], close=prices[-1])
+                asset.calculate_macd(prices=prices, dates=dates,
+                                     mongo_client=mongo_client)
+                asset.calculate_rsi(prices=prices, dates=dates,
+                                    mongo_client=mongo_client)
+                asset.calculate_ema_big_long(prices=prices, dates=dates,
+                                             mongo_client=mongo_client)
+
+        measure(label='compute_indicators', symbols=size,
+                symbol_days=symbol_days, run=batch)
+        measure(label='build_history', symbols=size,
+                symbol_days=symbol_days, run=build)
+        measure(label='calculate_and_insert', symbols=size,
+                symbol_days=symbol_days, run=insert)
+        measure(label='calculate_*', symbols=size,
+                symbol_days=symbol_days, run=calculate)
+
+        # Start every asset from its first stored day, then update daily
+        seed_days = INITIAL_DATA_POINTS + 1
+        assets = [
+            TrackedAsset.from_document(document=TrackedAsset(
+                symbol='X', date=dates[seed_days - 1],
+                close=prices[seed_days - 1]).build_history(
+                    prices=prices[:seed_days], dates=dates[:seed_days])[0])
+            for prices in universe]
+
+        def update() -> None:
+            for asset, prices in zip(assets, universe):
+                for price, date in zip(prices[seed_days:],
+                                       dates[seed_days:]):
+                    asset.update_stats(new_price=price, new_date=date)
+
+        measure(label='update_stats', symbols=size,
+                symbol_days=size * (days - seed_days), run=update)
+
+
+def trading_dates(days: int) -> list[datetime]:
+    return [FIRST_DATE + timedelta(days=day) for day in range(days)]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(UNIVERSE_SIZES),
+                        help='universe sizes to time')
+    parser.add_argument('--days', type=int, default=DAYS,
+                        help='trading days per symbol, above '
+                        + repr(INITIAL_DATA_POINTS))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if args.days <= INITIAL_DATA_POINTS + 1:
+        parser.error('--days must be above ' + repr(INITIAL_DATA_POINTS + 1))
+
+    run_benchmarks(random=Random(args.seed), sizes=args.sizes,
+                   days=args.days)
@@ -1,52 +1,27 @@
 """Determine if the market is open and react to splits and mergers"""
-from base64 import b64decode
 from datetime import date, datetime, timedelta, timezone
 from os import environ
-from time import sleep
-from urllib import parse
 
-from alpaca.data.historical.stock import StockHistoricalDataClient
-from alpaca.data.requests import StockBarsRequest
-from alpaca.data.timeframe import TimeFrame
-from alpaca.trading.client import TradingClient
 from alpaca.trading.enums import CorporateActionType
 from alpaca.trading.requests import GetCalendarRequest
 from alpaca.trading.requests import GetCorporateAnnouncementsRequest
-from boto3 import client as boto_client
-from pandas.tseries.offsets import BDay
-from pymongo import MongoClient
-from telegram import Bot
 
-from data.tracked_asset import TrackedAsset
+from data.alpaca_client import CALL_ERRORS
+from data.bar_cache import get_bar_cache
+from data.bootstrap import Lazy, log_cold_start
+from data.connections import alpaca_trading_client, mongo_client
+from data.handler import invocation
+from data.latest_snapshot import remove_latest, rescale_latest
+from data.notifier import CRITICAL, WARNING, notifier
+from data.storage import get_storage
+from data.tracked_asset import PRICE_FIELDS
 
-LAMBDA_FUNCTION_NAME = environ.get('AWS_LAMBDA_FUNCTION_NAME')
-kms_client = boto_client('kms')
+SPLITS_COLLECTION = 'SPLITS'
+# A split is recorded as pending before any row is rescaled
+SPLIT_APPLIED = 'applied'
+SPLIT_PENDING = 'pending'
 
-
-def decrypt_kms(enc_string: str) -> str:
-    return kms_client.decrypt(
-        CiphertextBlob=b64decode(enc_string),
-        EncryptionContext={'LambdaFunctionName': LAMBDA_FUNCTION_NAME}
-    )['Plaintext'].decode('utf-8')
-
-
-ID_DECRYPTED = decrypt_kms(enc_string=environ.get('APCA_API_KEY_ID'))
-KEY_DECRYPTED = decrypt_kms(enc_string=environ.get('APCA_API_SECRET_KEY'))
-BOT_DECRYPTED = decrypt_kms(enc_string=environ.get('TGM_BOT_TOKEN'))
-CHAT_DECRYPTED = decrypt_kms(enc_string=environ.get('TGM_CHAT_ID'))
-MONGO_DECRYPTED = decrypt_kms(
-    enc_string=environ.get('MONGO_CONNECTION_STRING'))
-
-alpaca_trading_client = TradingClient(
-    api_key=ID_DECRYPTED, secret_key=KEY_DECRYPTED, paper=False)
-alpaca_historical_client = StockHistoricalDataClient(
-    api_key=ID_DECRYPTED, secret_key=KEY_DECRYPTED)
-telegram_bot = Bot(token=BOT_DECRYPTED)
-
-session_encoded = parse.quote_plus(environ.get('AWS_SESSION_TOKEN'))
-mongo_connection_string = MONGO_DECRYPTED + session_encoded
-mongo_client = MongoClient(mongo_connection_string)
-stock_db = mongo_client.get_database(name='stocks')
+storage = Lazy(factory=lambda: get_storage(mongo_client=mongo_client))
 
 today = date.today()
 
@@ -59,38 +34,35 @@ def check_announcements() -> None:
             until=(today + timedelta(days=10)))
     announcements = alpaca_trading_client.get_corporate_annoucements(
             filter=news_request)
-    tracked_symbols = stock_db.list_collection_names()
+    tracked_symbols = storage.symbols()
+    splits = {}
     for announcement in announcements:
         affected_symbol = announcement.target_symbol
         if affected_symbol in tracked_symbols:
             if announcement.ca_type == CorporateActionType.MERGER:
                 message = 'Merger detected! Deleting asset: ' + affected_symbol
-                telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
-                stock_db.drop_collection(name_or_collection=affected_symbol)
+                notifier.notify(text=message)
+                storage.drop_symbol(symbol=affected_symbol)
+                remove_latest(
+                    mongo_client=mongo_client, symbols=[affected_symbol])
             elif announcement.ca_type == CorporateActionType.SPLIT:
                 if announcement.ex_date is None:
                     message = 'Split announcement contains None EX date! '
                     message += 'Symbol: ' + affected_symbol
-                    telegram_bot.send_message(
-                        text=message, chat_id=CHAT_DECRYPTED)
+                    notifier.notify(text=message, severity=WARNING)
                 elif announcement.ex_date == today:
                     message = 'Split detected! Updating: ' + affected_symbol
-                    telegram_bot.send_message(
-                        text=message, chat_id=CHAT_DECRYPTED)
-                    ex_datetime = datetime.combine(
-                        date=announcement.ex_date,
-                        time=datetime.min.time(),
-                        tzinfo=timezone.utc)
-                    perform_split(
-                        symbol=affected_symbol,
-                        old_rate=announcement.old_rate,
-                        new_rate=announcement.new_rate,
-                        ex_datetime=ex_datetime)
+                    notifier.notify(text=message)
+                    splits[affected_symbol] = (
+                        announcement.old_rate, announcement.new_rate)
             else:  # SPINOFF
                 message = 'Spinoff detected! PANIC: ' + affected_symbol
-                telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
-            # Sleep to not overload telegram
-            sleep(0.5)
+                notifier.notify(text=message, severity=CRITICAL)
+    if splits:
+        perform_splits(
+            splits=splits,
+            ex_datetime=datetime.combine(
+                date=today, time=datetime.min.time(), tzinfo=timezone.utc))
 
 
 def check_market_open() -> None:
@@ -99,16 +71,16 @@ def check_market_open() -> None:
     try:
         trading_calendar = alpaca_trading_client.get_calendar(
             filters=today_filter)
-    except AttributeError:
+    except (AttributeError, *CALL_ERRORS):
         error_message = 'Error fetching trading calendar! Filter: '
         error_message += repr(today_filter)
-        telegram_bot.send_message(text=error_message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=error_message, severity=CRITICAL)
         raise CheckMarketError
 
     if len(trading_calendar) > 1:
         error_message = 'Unexpected number of trading days returned! : '
         error_message += repr(len(trading_calendar))
-        telegram_bot.send_message(text=error_message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=error_message, severity=CRITICAL)
         raise CheckMarketError
 
     # API now only returns an object when the market is open
@@ -126,55 +98,69 @@ def check_market_open() -> None:
 
 
 def lambda_handler(event, context):
-    try:
-        check_market_open()
-        check_announcements()
-    except CheckMarketError:
+    global today
+    today = date.today()
+    with invocation():
+        try:
+            check_market_open()
+            check_announcements()
+        except CheckMarketError:
+            return
+        except Exception as err:
+            error_message = 'Unexpected exception: ' + repr(err)
+            notifier.notify(text=error_message, severity=CRITICAL)
+
+
+def perform_splits(splits: dict[str, tuple[float, float]],
+                   ex_datetime: datetime) -> None:
+    """Rescale stored history and state in place for same-day splits
+
+    Prices, EMAs, MACD, signal and the RSI averages scale linearly with the
+    split ratio, while RSI and trend are unchanged, so no bars are fetched.
+    A split still pending from an earlier run may be partly applied, so it
+    is reported instead of rescaled again.
+    """
+    market_db = mongo_client.get_database(name='market')
+    split_collection = market_db.get_collection(name=SPLITS_COLLECTION)
+    # Records written before statuses existed were always applied
+    recorded = {
+        document['symbol']: document.get('status', SPLIT_APPLIED)
+        for document in split_collection.find(
+            filter={'symbol': {'$in': list(splits)}, 'ex_date': ex_datetime})}
+    interrupted = sorted(symbol for symbol, status in recorded.items()
+                         if status == SPLIT_PENDING)
+    if interrupted:
+        message = 'Split interrupted on an earlier run, not reapplied: '
+        message += ', '.join(interrupted) + '. INVESTIGATE'
+        notifier.notify(text=message, severity=CRITICAL)
+    new_splits = {symbol: rates for symbol, rates in splits.items()
+                  if symbol not in recorded}
+    if not new_splits:
         return
-    except Exception as err:
-        error_message = 'Unexpected exception: ' + repr(err)
-        telegram_bot.send_message(text=error_message, chat_id=CHAT_DECRYPTED)
-    finally:
-        mongo_client.close()
-
-
-def perform_split(symbol: str, old_rate: float, new_rate: float,
-                  ex_datetime: datetime) -> None:
-    end_datetime = datetime.combine(date=today, time=datetime.min.time())
-    start_datetime = (today - BDay(310))
-    bars_request = StockBarsRequest(
-        symbol_or_symbols=symbol, start=start_datetime, end=end_datetime,
-        timeframe=TimeFrame.Day)
-    try:
-        bars_response = alpaca_historical_client.get_stock_bars(
-            request_params=bars_request)
-    except AttributeError:
-        message = 'Error fetching data while splitting: ' + symbol
-        telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
-        raise CheckMarketError
-
-    stock_db.drop_collection(name_or_collection=symbol)
-    bars = bars_response.data[symbol]
-
-    latest_bar = bars[-1]
-    latest_date = latest_bar.timestamp.replace(
-        hour=0, minute=0, second=0, microsecond=0)
-    asset = TrackedAsset(
-        symbol=symbol, date=latest_date, close=latest_bar.close)
-
-    prices = [candle.close for candle in bars]
-    dates = [candle.timestamp.replace(
-        hour=0, minute=0, second=0, microsecond=0) for candle in bars]
-
-    index = 0
-    while index < len(dates) and dates[index] < ex_datetime:
-        prices[index] = (prices[index] * old_rate / new_rate)
-        index += 1
-    asset.calculate_macd(prices=prices, dates=dates, mongo_client=mongo_client)
-    asset.calculate_rsi(prices=prices, dates=dates, mongo_client=mongo_client)
-    asset.calculate_ema_big_long(
-        prices=prices, dates=dates, mongo_client=mongo_client)
+    ratios = {symbol: old_rate / new_rate
+              for symbol, (old_rate, new_rate) in new_splits.items()}
+
+    split_collection.insert_many(documents=[
+        {'symbol': symbol, 'ex_date': ex_datetime, 'ratio': ratio,
+         'status': SPLIT_PENDING}
+        for symbol, ratio in ratios.items()])
+    storage.rescale(ratios=ratios, before=ex_datetime, fields=PRICE_FIELDS)
+    rescale_latest(mongo_client=mongo_client, ratios=ratios,
+                   before=ex_datetime, fields=PRICE_FIELDS)
+    split_collection.update_many(
+        filter={'symbol': {'$in': list(ratios)}, 'ex_date': ex_datetime},
+        update={'$set': {'status': SPLIT_APPLIED}})
+
+    bar_cache = get_bar_cache()
+    if bar_cache is not None:
+        for symbol, (old_rate, new_rate) in new_splits.items():
+            bar_cache.apply_split(
+                symbol=symbol, ex_datetime=ex_datetime, old_rate=old_rate,
+                new_rate=new_rate)
 
 
 class CheckMarketError(Exception):
     pass
+
+
+log_cold_start()
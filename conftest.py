@@ -0,0 +1,3 @@
+"""Pytest setup, kept at the root so tests import data from here"""
+# A backtest script that connects to Mongo, not a test module
+collect_ignore = ['test_strategy.py']
@@ -0,0 +1,136 @@
+"""Shared rate-limited access to the Alpaca API"""
+from collections import Counter
+from os import environ
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any
+
+from alpaca.common.exceptions import APIError
+from alpaca.data.historical.stock import StockHistoricalDataClient
+from alpaca.trading.client import TradingClient
+from requests.exceptions import ConnectionError as RequestConnectionError
+from requests.exceptions import Timeout
+
+# API free-rate limit: 200/min
+REQUESTS_PER_MINUTE = int(environ.get('ALPACA_REQUESTS_PER_MINUTE', '200'))
+BURST_SIZE = 10
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 8.0
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+# Errors a call can end with once its retries are spent
+CALL_ERRORS = (APIError, RequestConnectionError, Timeout)
+# Calls that change the account. Repeating one after a lost response would
+# act twice, so only a rate limit rejection is retried, unless the request
+# carries a client_order_id that Alpaca refuses to accept twice.
+ACCOUNT_ACTIONS = frozenset({
+    'cancel_order_by_id', 'cancel_orders', 'close_all_positions',
+    'close_position', 'replace_order_by_id', 'submit_order'})
+RATE_LIMITED_STATUS_CODE = 429
+
+# Calls made per client method, shared by every wrapped client
+CALL_COUNTS = Counter()
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at a fixed per-minute rate"""
+    def __init__(self, requests_per_minute: int, burst_size: int):
+        self.rate = requests_per_minute / 60
+        self.capacity = burst_size
+        self.tokens = float(burst_size)
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self) -> None:
+        """Reserve one token, sleeping until it is available"""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            sleep(wait)
+
+
+# Alpaca limits per account, so every client shares one budget
+shared_bucket = TokenBucket(
+    requests_per_minute=REQUESTS_PER_MINUTE, burst_size=BURST_SIZE)
+
+
+class RateLimitedClient:
+    """Proxy routing every Alpaca client method through the shared bucket"""
+    def __init__(self, client: Any, bucket: TokenBucket = shared_bucket,
+                 max_retries: int = MAX_RETRIES):
+        self.client = client
+        self.bucket = bucket
+        self.max_retries = max_retries
+
+    def __getattr__(self, name: str) -> Any:
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def limited_call(*args, **kwargs):
+            repeatable = is_repeatable(name=name, args=args, kwargs=kwargs)
+            for attempt in range(self.max_retries + 1):
+                self.bucket.acquire()
+                CALL_COUNTS[name] += 1
+                try:
+                    return attribute(*args, **kwargs)
+                except CALL_ERRORS as err:
+                    if (attempt == self.max_retries or not is_transient(err)
+                            or not (repeatable or is_rate_limited(err))):
+                        raise
+                    sleep(backoff_delay(attempt=attempt))
+        return limited_call
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for the given retry attempt"""
+    ceiling = min(BACKOFF_CAP_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+    return uniform(0, ceiling)
+
+
+def find_order(client: Any, client_order_id: str) -> Any:
+    """Order held under client_order_id, or None if Alpaca cannot confirm it"""
+    try:
+        return client.get_order_by_client_id(client_id=client_order_id)
+    except CALL_ERRORS:
+        # Unknown orders are a 404, lookups that fail are retried next run
+        return None
+
+
+def historical_client(api_key: str, secret_key: str) -> RateLimitedClient:
+    return RateLimitedClient(client=StockHistoricalDataClient(
+        api_key=api_key, secret_key=secret_key))
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """Rejected before Alpaca acted on it"""
+    return (isinstance(error, APIError)
+            and error.status_code == RATE_LIMITED_STATUS_CODE)
+
+
+def is_repeatable(name: str, args: tuple, kwargs: dict) -> bool:
+    """Whether sending the call twice cannot act on the account twice"""
+    if name not in ACCOUNT_ACTIONS:
+        return True
+    order_data = kwargs.get('order_data', args[0] if args else None)
+    return (name == 'submit_order'
+            and getattr(order_data, 'client_order_id', None) is not None)
+
+
+def is_transient(error: Exception) -> bool:
+    """Rate limiting, server errors and dropped connections are retried"""
+    if isinstance(error, APIError):
+        return error.status_code in TRANSIENT_STATUS_CODES
+    return True
+
+
+def trading_client(api_key: str, secret_key: str,
+                   paper: bool = False) -> RateLimitedClient:
+    return RateLimitedClient(client=TradingClient(
+        api_key=api_key, secret_key=secret_key, paper=paper))
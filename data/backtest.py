@@ -0,0 +1,243 @@
+"""Date-major vectorized backtest of the trading strategy"""
+from datetime import datetime
+from math import floor
+import os
+from typing import NamedTuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from data.bar_cache import BarCache
+from data.indicators import RSI_QUEUE, TREND_QUEUE, compute_indicators
+from data.strategy import (
+    FEATURES, LONG_ENTRY, MAX_OPEN_POSITIONS, SHORT_ENTRY, STOP_LOSS_PERCENT,
+    TARGET_PERCENT, TARGET_RSI, document_features)
+from data.tracked_asset import INITIAL_DATA_POINTS, VOLUME_THRESHOLD
+
+STARTING_FUNDS = 10000
+
+STORAGE_PROJECTION = {
+    '_id': False, 'date': True, 'close': True, 'macd': True,
+    'macd_signal': True, 'rsi': True, 'trend': True}
+
+
+class MarketArrays(NamedTuple):
+    """Strategy inputs aligned as symbols x days, NaN where not traded"""
+    symbols: list[str]
+    dates: np.ndarray
+    close: np.ndarray
+    macd: np.ndarray
+    macd_signal: np.ndarray
+    rsi_min: np.ndarray
+    rsi_max: np.ndarray
+    trend_any: np.ndarray
+    trend_all: np.ndarray
+
+
+class BacktestResult(NamedTuple):
+    final_funds: float
+    roi: float
+    max_drawdown: float
+    trade_count: int
+    equity: np.ndarray
+
+
+def align(rows: dict[str, dict[str, np.ndarray]]) -> MarketArrays:
+    """Place per-symbol columns onto the union of all trading dates"""
+    symbols = sorted(rows)
+    if symbols:
+        dates = np.unique(np.concatenate(
+            [rows[symbol]['dates'] for symbol in symbols]))
+    else:
+        dates = np.array([], dtype='datetime64[D]')
+    shape = (len(symbols), len(dates))
+    columns = {field: np.full(shape, np.nan) for field in (
+        'close', 'macd', 'macd_signal', 'rsi_min', 'rsi_max')}
+    columns.update({field: np.zeros(shape, dtype=bool)
+                    for field in ('trend_any', 'trend_all')})
+    for row, symbol in enumerate(symbols):
+        positions = np.searchsorted(dates, rows[symbol]['dates'])
+        for field, values in columns.items():
+            values[row, positions] = rows[symbol][field]
+    return MarketArrays(symbols=symbols, dates=dates, **columns)
+
+
+def load_from_cache(cache: BarCache, start: datetime = None,
+                    end: datetime = None) -> MarketArrays:
+    """Recompute every indicator from the local bar cache, fully offline"""
+    rows = {}
+    for symbol in cache.symbols():
+        columns = cache.select(
+            columns=cache.load(symbol=symbol), start=start, end=end)
+        volumes = columns['volume']
+        # Same thresholds as TrackedAsset.has_enough_trades
+        if (len(volumes) <= INITIAL_DATA_POINTS or volumes.min() == 0
+                or volumes.mean() < VOLUME_THRESHOLD):
+            continue
+        series = compute_indicators(closes=columns['close'])
+        rsi_windows = sliding_window_view(series.rsi, RSI_QUEUE, axis=-1)
+        trend_windows = sliding_window_view(
+            series.above_trend, TREND_QUEUE, axis=-1)
+        # Window ending at day i sits at row i - QUEUE + 1
+        stored = slice(INITIAL_DATA_POINTS, None)
+        rsi_stored = slice(INITIAL_DATA_POINTS - RSI_QUEUE + 1, None)
+        trend_stored = slice(INITIAL_DATA_POINTS - TREND_QUEUE + 1, None)
+        rows[symbol] = {
+            'dates': columns['timestamp'][stored].astype(
+                'datetime64[s]').astype('datetime64[D]'),
+            'close': columns['close'][stored],
+            'macd': series.macd[stored],
+            'macd_signal': series.macd_signal[stored],
+            # NaN-skipping, like strategy.window_extremes
+            'rsi_min': np.fmin.reduce(rsi_windows[rsi_stored], axis=-1),
+            'rsi_max': np.fmax.reduce(rsi_windows[rsi_stored], axis=-1),
+            'trend_any': trend_windows[trend_stored].any(axis=-1),
+            'trend_all': trend_windows[trend_stored].all(axis=-1)}
+    return align(rows=rows)
+
+
+def load_from_storage(storage) -> MarketArrays:
+    """Read stored indicator history for every symbol in one pass"""
+    rows = {}
+    for symbol in storage.symbols():
+        documents = list(storage.history(
+            symbol=symbol, projection=STORAGE_PROJECTION))
+        if not documents:
+            continue
+        features = [document_features(document=document)
+                    for document in documents]
+        rows[symbol] = {
+            'dates': np.array([document['date'] for document in documents],
+                              dtype='datetime64[D]'),
+            'close': [document['close'] for document in documents],
+            **{name: [row[name] for row in features] for name in FEATURES}}
+    return align(rows=rows)
+
+
+def load_market(directory: str) -> MarketArrays:
+    """Memory-map arrays written by save_market, read-only and shared"""
+    return MarketArrays(**{
+        field: np.load(os.path.join(directory, field + '.npy'),
+                       mmap_mode='r')
+        for field in MarketArrays._fields})
+
+
+def run_backtest(market: MarketArrays, funds: float = STARTING_FUNDS,
+                 target_rsi: float = TARGET_RSI,
+                 target_percent: float = TARGET_PERCENT,
+                 stop_loss_percent: float = STOP_LOSS_PERCENT,
+                 max_open_positions: int = MAX_OPEN_POSITIONS,
+                 verbose: bool = False) -> BacktestResult:
+    """Step through dates, trading the whole universe with array operations
+
+    Entries are sized and capped as in manage_trades.execute_entry_orders.
+    Exits follow the stop loss, target and MACD crossover rules.
+    """
+    starting_funds = funds
+    symbol_count, day_count = market.close.shape
+    quantity = np.zeros(symbol_count)
+    entry_price = np.zeros(symbol_count)
+    is_long = np.zeros(symbol_count, dtype=bool)
+    target_met = np.zeros(symbol_count, dtype=bool)
+    last_close = np.full(symbol_count, np.nan)
+    equity = np.empty(day_count)
+    trade_count = 0
+
+    with np.errstate(invalid='ignore'):
+        for day in range(day_count):
+            close = market.close[:, day]
+            traded = ~np.isnan(close)
+            last_close = np.where(traded, close, last_close)
+            macd_bigger = market.macd[:, day] > market.macd_signal[:, day]
+            macd_smaller = market.macd[:, day] < market.macd_signal[:, day]
+
+            # Exits for positions held before today
+            held_long = (quantity > 0) & is_long & traded
+            held_short = (quantity > 0) & ~is_long & traded
+            stop_long = held_long & (
+                close <= entry_price * (100 - stop_loss_percent) / 100)
+            stop_short = held_short & (
+                close >= entry_price * (100 + stop_loss_percent) / 100)
+            target_met |= (
+                (held_long & ~stop_long
+                 & (close >= entry_price * (100 + target_percent) / 100))
+                | (held_short & ~stop_short
+                   & (close <= entry_price * (100 - target_percent) / 100)))
+            exit_long = stop_long | (held_long & target_met & ~macd_bigger)
+            exit_short = stop_short | (
+                held_short & target_met & ~macd_smaller)
+            exited = exit_long | exit_short
+            funds += (quantity[exit_long] * close[exit_long]).sum()
+            funds -= (quantity[exit_short] * close[exit_short]).sum()
+            if verbose:
+                for row in np.flatnonzero(exited):
+                    print('Exit: ' + market.symbols[row] + ' - '
+                          + repr(float(close[row])) + ' - '
+                          + str(market.dates[day]))
+            quantity[exited] = 0
+            target_met[exited] = False
+
+            # Entries, never re-entering a symbol exited today. Rules see
+            # one day's column views, so mapped arrays are never copied.
+            features = {name: getattr(market, name)[:, day]
+                        for name in FEATURES}
+            available = traded & (quantity == 0) & ~exited
+            long_signals = np.flatnonzero(available & LONG_ENTRY.evaluate(
+                features=features, target_rsi=target_rsi))
+            short_signals = np.flatnonzero(available & SHORT_ENTRY.evaluate(
+                features=features, target_rsi=target_rsi))
+            num_positions = int((quantity > 0).sum())
+            for signals, side_is_long in ((long_signals, True),
+                                          (short_signals, False)):
+                if num_positions >= max_open_positions or not len(signals):
+                    continue
+                if num_positions + len(signals) > max_open_positions:
+                    signals = signals[np.argsort(
+                        close[signals], kind='stable')]
+                txn_amount = funds / (max_open_positions - num_positions)
+                for row in signals.tolist():
+                    if num_positions == max_open_positions:
+                        break
+                    if txn_amount < close[row]:
+                        continue
+                    quantity[row] = floor(txn_amount / close[row])
+                    entry_price[row] = close[row]
+                    is_long[row] = side_is_long
+                    if side_is_long:
+                        funds -= quantity[row] * close[row]
+                    else:
+                        funds += quantity[row] * close[row]
+                    num_positions += 1
+                    trade_count += 1
+                    if verbose:
+                        print(('Long' if side_is_long else 'Short')
+                              + ' entry: ' + market.symbols[row] + ' - '
+                              + repr(float(close[row])) + ' - '
+                              + str(market.dates[day]))
+
+            held = quantity > 0
+            signed = np.where(is_long, 1.0, -1.0)
+            equity[day] = funds + np.nansum(
+                (signed * quantity * last_close)[held])
+
+    # Open positions are valued at their last close
+    held = quantity > 0
+    final_funds = float(funds + np.nansum(
+        (np.where(is_long, 1.0, -1.0) * quantity * last_close)[held]))
+    if day_count:
+        peaks = np.maximum.accumulate(
+            np.concatenate(([starting_funds], equity)))[1:]
+        max_drawdown = float(((peaks - equity) / peaks).max() * 100)
+    else:
+        max_drawdown = 0.0
+    return BacktestResult(
+        final_funds=final_funds,
+        roi=(final_funds - starting_funds) / starting_funds * 100,
+        max_drawdown=max_drawdown, trade_count=trade_count, equity=equity)
+
+
+def save_market(market: MarketArrays, directory: str) -> None:
+    """Write one .npy per field so worker processes can map them"""
+    os.makedirs(directory, exist_ok=True)
+    for field, values in market._asdict().items():
+        np.save(os.path.join(directory, field + '.npy'), np.asarray(values))
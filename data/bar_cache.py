@@ -0,0 +1,186 @@
+"""Local columnar OHLCV cache backed by one .npy file per field"""
+from datetime import datetime, timezone
+from math import isclose
+import os
+from typing import Any, NamedTuple
+
+from alpaca.data.enums import Adjustment
+from alpaca.data.requests import StockBarsRequest
+from alpaca.data.timeframe import TimeFrame
+import numpy as np
+
+# Cache is disabled unless a directory is configured
+BAR_CACHE_DIR = os.environ.get('BAR_CACHE_DIR')
+BAR_CACHE_OFFLINE = os.environ.get('BAR_CACHE_OFFLINE') == '1'
+PRICE_FIELDS = ('open', 'high', 'low', 'close')
+FIELDS = ('timestamp', *PRICE_FIELDS, 'volume')
+
+
+class CachedBar(NamedTuple):
+    """Drop-in for the alpaca Bar fields the loaders read"""
+    timestamp: datetime
+    open: float
+    high: float
+    low: float
+    close: float
+    volume: float
+
+
+def to_epoch(moment: datetime) -> int:
+    """Seconds since epoch, treating naive datetimes as UTC"""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def columns_from_bars(bars: list[Any]) -> dict[str, np.ndarray]:
+    columns = {'timestamp': np.array(
+        [to_epoch(candle.timestamp) for candle in bars], dtype=np.int64)}
+    for field in (*PRICE_FIELDS, 'volume'):
+        columns[field] = np.array(
+            [getattr(candle, field) for candle in bars], dtype=np.float64)
+    return columns
+
+
+class BarCache:
+    """Per-symbol directories of timestamp, open, high, low, close, volume"""
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+
+    def append(self, symbol: str, bars: list[Any]) -> int:
+        """Append bars newer than the cached history, returning the count"""
+        new_columns = columns_from_bars(bars=bars)
+        columns = self.load(symbol=symbol)
+        if columns is not None and len(columns['timestamp']):
+            newer = new_columns['timestamp'] > columns['timestamp'][-1]
+            new_columns = {field: values[newer]
+                           for field, values in new_columns.items()}
+            new_columns = {
+                field: np.concatenate((columns[field], new_columns[field]))
+                for field in FIELDS}
+            added = int(newer.sum())
+        else:
+            added = len(new_columns['timestamp'])
+        if added:
+            self.write(symbol=symbol, columns=new_columns)
+        return added
+
+    def apply_split(self, symbol: str, ex_datetime: datetime,
+                    old_rate: float, new_rate: float) -> None:
+        """Rescale all bars before the ex date so history stays adjusted"""
+        columns = self.load(symbol=symbol)
+        if columns is None:
+            return
+        columns = {field: np.array(values) for field, values in columns.items()}
+        before = columns['timestamp'] < to_epoch(ex_datetime)
+        for field in PRICE_FIELDS:
+            columns[field][before] *= old_rate / new_rate
+        columns['volume'][before] *= new_rate / old_rate
+        self.write(symbol=symbol, columns=columns)
+
+    def bars(self, symbol: str, start: datetime = None,
+             end: datetime = None) -> list[CachedBar]:
+        """Cached bars within the inclusive date range"""
+        columns = self.load(symbol=symbol)
+        if columns is None:
+            return []
+        selected = self.select(columns=columns, start=start, end=end)
+        return [
+            CachedBar(
+                datetime.fromtimestamp(timestamp, tz=timezone.utc),
+                *values)
+            for timestamp, *values in zip(
+                selected['timestamp'].tolist(),
+                *(selected[field].tolist() for field in FIELDS[1:]))]
+
+    def last_timestamp(self, symbol: str) -> datetime:
+        columns = self.load(symbol=symbol)
+        if columns is None or not len(columns['timestamp']):
+            return None
+        return datetime.fromtimestamp(
+            int(columns['timestamp'][-1]), tz=timezone.utc)
+
+    def load(self, symbol: str) -> dict[str, np.ndarray]:
+        """Memory-mapped columns for symbol, or None when not cached"""
+        if not os.path.exists(self.path(symbol=symbol, field='timestamp')):
+            return None
+        return {field: np.load(self.path(symbol=symbol, field=field),
+                               mmap_mode='r')
+                for field in FIELDS}
+
+    def path(self, symbol: str, field: str) -> str:
+        return os.path.join(self.cache_dir, symbol, field + '.npy')
+
+    @staticmethod
+    def select(columns: dict[str, np.ndarray], start: datetime = None,
+               end: datetime = None) -> dict[str, np.ndarray]:
+        timestamps = columns['timestamp']
+        low = 0
+        high = len(timestamps)
+        if start is not None:
+            low = np.searchsorted(timestamps, to_epoch(start), side='left')
+        if end is not None:
+            high = np.searchsorted(timestamps, to_epoch(end), side='right')
+        return {field: values[low:high] for field, values in columns.items()}
+
+    def symbols(self) -> list[str]:
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return sorted(
+            symbol for symbol in os.listdir(self.cache_dir)
+            if os.path.exists(self.path(symbol=symbol, field='timestamp')))
+
+    def write(self, symbol: str, columns: dict[str, np.ndarray]) -> None:
+        """Replace every field file, renaming into place once written"""
+        os.makedirs(os.path.join(self.cache_dir, symbol), exist_ok=True)
+        for field in FIELDS:
+            path = self.path(symbol=symbol, field=field)
+            with open(path + '.tmp', 'wb') as field_file:
+                np.save(field_file, np.ascontiguousarray(columns[field]))
+            os.replace(path + '.tmp', path)
+
+
+def fetch_with_cache(cache: BarCache, client: Any, symbol: str,
+                     start: datetime, end: datetime,
+                     adjustment: Adjustment = Adjustment.SPLIT,
+                     offline: bool = BAR_CACHE_OFFLINE) -> list[CachedBar]:
+    """Fetch only bars missing from the cache, then serve from disk
+
+    The last cached bar is refetched as an overlap check. A changed close
+    means the history was re-adjusted upstream, so it is downloaded again.
+    """
+    if offline:
+        return cache.bars(symbol=symbol, start=start, end=end)
+
+    last_cached = cache.last_timestamp(symbol=symbol)
+    bars = request_bars(
+        client=client, symbol=symbol,
+        start=start if last_cached is None else last_cached, end=end,
+        adjustment=adjustment)
+    if (last_cached is not None and bars
+            and bars[0].timestamp == last_cached
+            and not isclose(bars[0].close,
+                            float(cache.load(symbol=symbol)['close'][-1]),
+                            rel_tol=1e-6)):
+        bars = request_bars(client=client, symbol=symbol, start=start,
+                            end=end, adjustment=adjustment)
+        cache.write(symbol=symbol, columns=columns_from_bars(bars=bars))
+    else:
+        cache.append(symbol=symbol, bars=bars)
+    return cache.bars(symbol=symbol, start=start, end=end)
+
+
+def get_bar_cache() -> BarCache:
+    """Configured cache, or None when BAR_CACHE_DIR is unset"""
+    if BAR_CACHE_DIR is None:
+        return None
+    return BarCache(cache_dir=BAR_CACHE_DIR)
+
+
+def request_bars(client: Any, symbol: str, start: datetime, end: datetime,
+                 adjustment: Adjustment) -> list[Any]:
+    bars_request = StockBarsRequest(
+        symbol_or_symbols=symbol, start=start, end=end,
+        timeframe=TimeFrame.Day, adjustment=adjustment)
+    bars_response = client.get_stock_bars(request_params=bars_request)
+    return bars_response.data.get(symbol, [])
@@ -0,0 +1,157 @@
+"""Lazy, cached decryption of the Lambda secrets
+
+Nothing is decrypted at import. The first get_secret call decrypts every
+configured secret concurrently and keeps the plaintext for the lifetime of
+the execution environment. When SECRET_CACHE_KEY holds a Fernet key and
+cryptography is installed, the plaintext is also kept encrypted in /tmp
+for SECRET_CACHE_TTL_SECONDS so a recycled process can skip KMS entirely.
+"""
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable
+
+from boto3 import client as boto_client
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+SECRET_NAMES = ('APCA_API_KEY_ID', 'APCA_API_SECRET_KEY', 'TGM_BOT_TOKEN',
+                'TGM_CHAT_ID', 'MONGO_CONNECTION_STRING')
+LAMBDA_FUNCTION_NAME = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+SECRET_CACHE_KEY = os.environ.get('SECRET_CACHE_KEY')
+SECRET_CACHE_TTL_SECONDS = int(
+    os.environ.get('SECRET_CACHE_TTL_SECONDS', '3600'))
+SECRET_CACHE_PATH = os.path.join(
+    '/tmp', 'secrets-' + (LAMBDA_FUNCTION_NAME or 'local') + '.cache')
+
+# Plaintext by environment variable name, filled on first use
+plaintexts = {}
+# Milliseconds spent the first time each lazy dependency was built
+first_use_ms = {}
+plaintexts_lock = Lock()
+# Every Lazy created, so a credential change can reset them all
+lazy_objects = []
+
+
+class Lazy:
+    """Proxy that builds the wrapped object on first attribute access"""
+    def __init__(self, factory: Callable[[], Any]):
+        self.factory = factory
+        self.instance = None
+        self.lock = Lock()
+        lazy_objects.append(self)
+
+    def __getattr__(self, name: str) -> Any:
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    self.instance = self.factory()
+        return getattr(self.instance, name)
+
+    def reset(self) -> Any:
+        """Forget the built object so the next access rebuilds it"""
+        with self.lock:
+            instance = self.instance
+            self.instance = None
+        return instance
+
+
+def decrypt_all(names: list[str]) -> dict[str, str]:
+    """Decrypt every named secret with one KMS request per thread"""
+    if not names:
+        # Local and test runs may set none of the encrypted variables
+        return {}
+    kms_client = boto_client('kms')
+
+    def decrypt_kms(name: str) -> str:
+        return kms_client.decrypt(
+            CiphertextBlob=b64decode(os.environ.get(name)),
+            EncryptionContext={'LambdaFunctionName': LAMBDA_FUNCTION_NAME}
+        )['Plaintext'].decode('utf-8')
+
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        return dict(zip(names, executor.map(decrypt_kms, names)))
+
+
+def ensure_secrets() -> None:
+    """Decrypt every secret unless that already happened"""
+    if not plaintexts:
+        with plaintexts_lock:
+            if not plaintexts:
+                load_secrets()
+
+
+def get_secret(name: str) -> str:
+    """Plaintext of an encrypted environment variable"""
+    ensure_secrets()
+    return plaintexts[name]
+
+
+def load_secrets() -> None:
+    started = perf_counter()
+    source = 'cache'
+    values = read_secret_cache()
+    if values is None:
+        source = 'KMS'
+        values = decrypt_all(
+            names=[name for name in SECRET_NAMES if os.environ.get(name)])
+        write_secret_cache(values=values)
+    plaintexts.update(values)
+    elapsed_ms = (perf_counter() - started) * 1000
+    first_use_ms.setdefault('secrets', round(elapsed_ms))
+    print('Secrets loaded from ' + source + ' in '
+          + '{:.0f}'.format(elapsed_ms) + ' ms')
+
+
+def log_cold_start() -> None:
+    """Print how long the process has run, called once imports finish"""
+    try:
+        age = process_age()
+    except OSError:
+        # /proc only exists on Linux, which is all Lambda runs
+        return
+    print('Cold start init: ' + '{:.0f}'.format(age * 1000) + ' ms')
+
+
+def process_age() -> float:
+    """Seconds since this process started, from /proc"""
+    with open('/proc/self/stat') as stat_file:
+        # The command name may hold spaces, so count fields after its ')'
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+    with open('/proc/uptime') as uptime_file:
+        uptime = float(uptime_file.read().split()[0])
+    # Field 22 of stat, the start time in clock ticks after boot
+    return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+
+
+def read_secret_cache() -> dict[str, str]:
+    """Cached plaintext, or None when disabled, missing or expired"""
+    if (Fernet is None or SECRET_CACHE_KEY is None
+            or not os.path.exists(SECRET_CACHE_PATH)):
+        return None
+    with open(SECRET_CACHE_PATH, 'rb') as cache_file:
+        token = cache_file.read()
+    try:
+        # Fernet tokens carry their creation time, which enforces the TTL
+        return json.loads(Fernet(SECRET_CACHE_KEY).decrypt(
+            token, ttl=SECRET_CACHE_TTL_SECONDS))
+    except InvalidToken:
+        return None
+
+
+def write_secret_cache(values: dict[str, str]) -> None:
+    if Fernet is None or SECRET_CACHE_KEY is None:
+        return
+    token = Fernet(SECRET_CACHE_KEY).encrypt(json.dumps(values).encode())
+    descriptor = os.open(SECRET_CACHE_PATH + '.tmp',
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'wb') as cache_file:
+        cache_file.write(token)
+    os.replace(SECRET_CACHE_PATH + '.tmp', SECRET_CACHE_PATH)
+
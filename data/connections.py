@@ -0,0 +1,149 @@
+"""Clients kept open across warm Lambda invocations
+
+Module globals survive between invocations of the same execution
+environment, so the Mongo pool and the Alpaca and Telegram HTTP sessions
+are built once and reused. They are only rebuilt when the AWS session token
+embedded in the Mongo connection string rotates.
+"""
+from collections import Counter
+import os
+from time import perf_counter
+from typing import Any, Callable
+from urllib import parse
+
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from telegram import Bot
+
+from data.alpaca_client import historical_client, trading_client
+from data.bootstrap import (
+    Lazy, ensure_secrets, first_use_ms, get_secret, lazy_objects)
+
+SESSION_TOKEN_VARIABLE = 'AWS_SESSION_TOKEN'
+
+
+class PoolCounter(ConnectionPoolListener):
+    """Count Mongo pool events for the connection statistics"""
+    def __init__(self):
+        self.counts = Counter()
+
+    def connection_check_out_failed(self, event):
+        self.counts['check_out_failed'] += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        self.counts['checked_in'] += 1
+
+    def connection_checked_out(self, event):
+        self.counts['checked_out'] += 1
+
+    def connection_closed(self, event):
+        self.counts['closed'] += 1
+
+    def connection_created(self, event):
+        self.counts['created'] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.counts['pool_cleared'] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+
+class ConnectionManager:
+    """Owns the shared clients and rebuilds them when credentials rotate"""
+    def __init__(self):
+        self.session_token = os.environ.get(SESSION_TOKEN_VARIABLE)
+        self.builds = Counter()
+        self.invocations = 0
+        self.pool_counter = PoolCounter()
+        self.alpaca_trading_client = Lazy(factory=self.timed(
+            name='alpaca_trading', factory=self.build_trading_client))
+        self.alpaca_historical_client = Lazy(factory=self.timed(
+            name='alpaca_historical', factory=self.build_historical_client))
+        self.mongo_client = Lazy(factory=self.timed(
+            name='mongo', factory=self.build_mongo_client))
+        self.telegram_bot = Lazy(factory=self.timed(
+            name='telegram', factory=self.build_telegram_bot))
+
+    def build_historical_client(self):
+        return historical_client(
+            api_key=get_secret(name='APCA_API_KEY_ID'),
+            secret_key=get_secret(name='APCA_API_SECRET_KEY'))
+
+    def build_mongo_client(self) -> MongoClient:
+        session_encoded = parse.quote_plus(self.session_token)
+        return MongoClient(
+            get_secret(name='MONGO_CONNECTION_STRING') + session_encoded,
+            event_listeners=[self.pool_counter])
+
+    def build_telegram_bot(self) -> Bot:
+        return Bot(token=get_secret(name='TGM_BOT_TOKEN'))
+
+    def build_trading_client(self):
+        return trading_client(
+            api_key=get_secret(name='APCA_API_KEY_ID'),
+            secret_key=get_secret(name='APCA_API_SECRET_KEY'), paper=False)
+
+    def start_invocation(self) -> None:
+        """Reuse every open client unless the session token changed"""
+        self.invocations += 1
+        session_token = os.environ.get(SESSION_TOKEN_VARIABLE)
+        if session_token == self.session_token:
+            return
+        print('Session token rotated, rebuilding connections')
+        self.session_token = session_token
+        # Objects derived from the old clients are rebuilt as well
+        for lazy_object in lazy_objects:
+            instance = lazy_object.reset()
+            if isinstance(instance, MongoClient):
+                instance.close()
+
+    def stats(self) -> dict:
+        """Builds per client and Mongo pool activity since cold start"""
+        counts = self.pool_counter.counts
+        stats = {'invocations': self.invocations,
+                 'builds': dict(self.builds),
+                 'mongo_pool': dict(counts),
+                 'mongo_open': counts['created'] - counts['closed']}
+        if self.invocations == 1:
+            # Deferred out of the cold start, so paid by the first request
+            stats['first_use_ms'] = dict(first_use_ms)
+        return stats
+
+    def timed(self, name: str,
+              factory: Callable[[], Any]) -> Callable[[], Any]:
+        """Wrap factory to count its builds and time the first one"""
+        def build() -> Any:
+            self.builds[name] += 1
+            # Decryption is timed on its own, not charged to this client
+            ensure_secrets()
+            started = perf_counter()
+            instance = factory()
+            first_use_ms.setdefault(
+                name, round((perf_counter() - started) * 1000))
+            return instance
+        return build
+
+
+connections = ConnectionManager()
+alpaca_historical_client = connections.alpaca_historical_client
+alpaca_trading_client = connections.alpaca_trading_client
+mongo_client = connections.mongo_client
+telegram_bot = connections.telegram_bot
+
+
+def send_message(text: str) -> None:
+    telegram_bot.send_message(
+        text=text, chat_id=get_secret(name='TGM_CHAT_ID'))
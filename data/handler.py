@@ -0,0 +1,23 @@
+"""Bookkeeping shared by every Lambda handler invocation"""
+from contextlib import contextmanager
+from typing import Iterator
+
+from data.alpaca_client import CALL_COUNTS
+from data.connections import connections
+from data.notifier import notifier
+
+
+@contextmanager
+def invocation() -> Iterator[None]:
+    """Reuse open connections, then report usage and send the digest
+
+    Module globals survive warm invocations, so a handler resets its
+    per-day state, such as today, before entering.
+    """
+    connections.start_invocation()
+    try:
+        yield
+    finally:
+        print('Alpaca calls: ' + repr(dict(CALL_COUNTS)))
+        print('Connections: ' + repr(connections.stats()))
+        notifier.flush()
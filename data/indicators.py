@@ -0,0 +1,143 @@
+"""Vectorized technical analysis engine for closing price series"""
+from math import log
+from typing import NamedTuple
+
+import numpy as np
+
+EMA_BIG_LONG_PERIOD = 200
+MACD_LONG_PERIOD = 26
+MACD_SHORT_PERIOD = 12
+MACD_SIGNAL_PERIOD = 9
+RSI_PERIOD = 14
+RSI_QUEUE = 5
+TREND_QUEUE = 20
+
+SMOOTH_9 = 0.2
+SMOOTH_12 = 0.153846153846
+SMOOTH_26 = 0.074074074074
+SMOOTH_200 = 0.0099502487562189
+
+# Largest decay ** -chunk_length allowed, far below float64 overflow
+FILTER_GROWTH_LIMIT = 1e50
+
+
+class IndicatorSeries(NamedTuple):
+    """Full indicator history, aligned index for index with the closes"""
+    ema_short: np.ndarray
+    ema_long: np.ndarray
+    macd: np.ndarray
+    macd_signal: np.ndarray
+    average_gains: np.ndarray
+    average_losses: np.ndarray
+    rsi: np.ndarray
+    ema_big_long: np.ndarray
+    above_trend: np.ndarray
+
+
+def compute_indicators(closes) -> IndicatorSeries:
+    """Calculate every indicator series for closes shaped (..., days)"""
+    closes = np.asarray(closes, dtype=np.float64)
+    ema_short, ema_long, macd, macd_signal = macd_series(closes)
+    average_gains, average_losses, rsi = rsi_series(closes)
+    ema_big_long, above_trend = ema_big_long_series(closes)
+    return IndicatorSeries(
+        ema_short=ema_short, ema_long=ema_long, macd=macd,
+        macd_signal=macd_signal, average_gains=average_gains,
+        average_losses=average_losses, rsi=rsi, ema_big_long=ema_big_long,
+        above_trend=above_trend)
+
+
+def ema_big_long_series(closes) -> tuple[np.ndarray, np.ndarray]:
+    """Calculate long-period trend line and whether each close is above it"""
+    closes = np.asarray(closes, dtype=np.float64)
+    ema_big_long = seeded_ema(
+        values=closes, period=EMA_BIG_LONG_PERIOD, smoothing=SMOOTH_200)
+    with np.errstate(invalid='ignore'):
+        above_trend = closes > ema_big_long
+    return ema_big_long, above_trend
+
+
+def linear_filter(values: np.ndarray, gain: float, decay: float,
+                  initial) -> np.ndarray:
+    """Evaluate y[k] = decay * y[k-1] + gain * values[k] along the last axis
+
+    Each chunk is solved in closed form with a cumulative sum instead of
+    stepping through the elements one at a time.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    result = np.empty_like(values)
+    previous = np.asarray(initial, dtype=np.float64)
+    chunk_length = max(1, int(log(FILTER_GROWTH_LIMIT) / -log(decay)))
+    for start in range(0, values.shape[-1], chunk_length):
+        chunk = values[..., start:start + chunk_length]
+        powers = decay ** np.arange(1, chunk.shape[-1] + 1)
+        filtered = powers * (previous[..., None]
+                             + gain * np.cumsum(chunk / powers, axis=-1))
+        result[..., start:start + chunk_length] = filtered
+        previous = filtered[..., -1]
+    return result
+
+
+def macd_series(closes) -> tuple[np.ndarray, np.ndarray,
+                                 np.ndarray, np.ndarray]:
+    """Calculate short EMA, long EMA, MACD and MACD signal"""
+    closes = np.asarray(closes, dtype=np.float64)
+    ema_short = seeded_ema(
+        values=closes, period=MACD_SHORT_PERIOD, smoothing=SMOOTH_12)
+    ema_long = seeded_ema(
+        values=closes, period=MACD_LONG_PERIOD, smoothing=SMOOTH_26)
+    macd = ema_short - ema_long
+
+    # Signal is seeded from the first MACD_SIGNAL_PERIOD full MACD values
+    macd_signal = np.full(closes.shape, np.nan)
+    signal_start = MACD_LONG_PERIOD + MACD_SIGNAL_PERIOD
+    if closes.shape[-1] >= signal_start:
+        signal_seed = macd[..., MACD_LONG_PERIOD:signal_start].mean(axis=-1)
+        macd_signal[..., signal_start - 1] = signal_seed
+        macd_signal[..., signal_start:] = linear_filter(
+            values=macd[..., signal_start:], gain=SMOOTH_9,
+            decay=1 - SMOOTH_9, initial=signal_seed)
+    return ema_short, ema_long, macd, macd_signal
+
+
+def rsi_series(closes) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Calculate Wilder-smoothed average gains, average losses and RSI"""
+    closes = np.asarray(closes, dtype=np.float64)
+    changes = np.diff(closes, axis=-1)
+    gains = np.maximum(changes, 0.0)
+    losses = np.maximum(-changes, 0.0)
+
+    # Index i holds the averages after the change into closes[i]
+    average_gains = np.full(closes.shape, np.nan)
+    average_losses = np.full(closes.shape, np.nan)
+    if closes.shape[-1] > RSI_PERIOD:
+        for averages, moves in ((average_gains, gains),
+                                (average_losses, losses)):
+            seed = moves[..., :RSI_PERIOD].mean(axis=-1)
+            averages[..., RSI_PERIOD] = seed
+            averages[..., RSI_PERIOD + 1:] = linear_filter(
+                values=moves[..., RSI_PERIOD:], gain=1 / RSI_PERIOD,
+                decay=(RSI_PERIOD - 1) / RSI_PERIOD, initial=seed)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi = 100 - 100 / (1 + average_gains / average_losses)
+    return average_gains, average_losses, rsi
+
+
+def seeded_ema(values: np.ndarray, period: int,
+               smoothing: float) -> np.ndarray:
+    """EMA seeded with the simple average of the first period values"""
+    ema = np.full(values.shape, np.nan)
+    if values.shape[-1] < period:
+        return ema
+    seed = values[..., :period].mean(axis=-1)
+    ema[..., period - 1] = seed
+    ema[..., period:] = linear_filter(
+        values=values[..., period:], gain=smoothing, decay=1 - smoothing,
+        initial=seed)
+    return ema
+
+
+def window(series: np.ndarray, index: int, length: int) -> list:
+    """Return the trailing window ending at index as a plain list"""
+    return series[..., index - length + 1:index + 1].tolist()
@@ -0,0 +1,63 @@
+"""Collection holding the most recent document of every tracked symbol
+
+Each snapshot is also the complete incremental state TrackedAsset needs,
+so the daily update reads and writes state here instead of the history.
+"""
+from datetime import datetime
+
+from pymongo import MongoClient, ReplaceOne, UpdateOne
+from pymongo.collection import Collection
+
+# Lives in the market DB so stocks only ever contains symbol collections
+LATEST_COLLECTION = 'LATEST'
+
+
+def ensure_index(mongo_client: MongoClient) -> None:
+    latest_collection(mongo_client=mongo_client).create_index(
+        keys='symbol', unique=True)
+
+
+def find_latest(mongo_client: MongoClient,
+                latest_date: datetime) -> dict[str, dict]:
+    """Return every snapshot for latest_date keyed by symbol in one query"""
+    cursor = latest_collection(mongo_client=mongo_client).find(
+        filter={'date': latest_date}, projection={'_id': False})
+    return {snapshot['symbol']: snapshot for snapshot in cursor}
+
+
+def latest_collection(mongo_client: MongoClient) -> Collection:
+    market_db = mongo_client.get_database(name='market')
+    return market_db.get_collection(name=LATEST_COLLECTION)
+
+
+def remove_latest(mongo_client: MongoClient, symbols: list[str]) -> None:
+    if symbols:
+        latest_collection(mongo_client=mongo_client).delete_many(
+            filter={'symbol': {'$in': symbols}})
+
+
+def rescale_latest(mongo_client: MongoClient, ratios: dict[str, float],
+                   before: datetime, fields: tuple[str, ...]) -> None:
+    """Apply split ratios to snapshots dated before `before` in one write"""
+    requests = [
+        UpdateOne(
+            filter={'symbol': symbol, 'date': {'$lt': before}},
+            update={'$mul': {field: ratio for field in fields}})
+        for symbol, ratio in ratios.items()]
+    if requests:
+        latest_collection(mongo_client=mongo_client).bulk_write(
+            requests=requests, ordered=False)
+
+
+def replace_latest(mongo_client: MongoClient, documents: list[dict]) -> None:
+    """Upsert one snapshot per symbol with a single bulk write"""
+    requests = [
+        ReplaceOne(
+            filter={'symbol': document['symbol']},
+            replacement={key: value for key, value in document.items()
+                         if key != '_id'},
+            upsert=True)
+        for document in documents]
+    if requests:
+        latest_collection(mongo_client=mongo_client).bulk_write(
+            requests=requests, ordered=False)
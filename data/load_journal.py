@@ -0,0 +1,61 @@
+"""Progress journal of the initial load, one entry per symbol
+
+Entries are written only after the rows they describe, so after a crash
+the journal never claims more than storage holds. A resumed load skips
+every symbol it lists as completed or rejected and retries the rest.
+"""
+from datetime import datetime
+
+from pymongo import DESCENDING, MongoClient, ReplaceOne
+from pymongo.collection import Collection
+
+JOURNAL_COLLECTION = 'LOAD_JOURNAL'
+
+COMPLETED = 'completed'
+FAILED = 'failed'
+REJECTED = 'rejected'
+
+
+def clear_journal(mongo_client: MongoClient) -> None:
+    journal_collection(mongo_client=mongo_client).delete_many(filter={})
+
+
+def finished_symbols(mongo_client: MongoClient) -> set[str]:
+    """Symbols a resumed load does not need to fetch again"""
+    cursor = journal_collection(mongo_client=mongo_client).find(
+        filter={'status': {'$in': [COMPLETED, REJECTED]}},
+        projection={'_id': False, 'symbol': True})
+    return {entry['symbol'] for entry in cursor}
+
+
+def journal_collection(mongo_client: MongoClient) -> Collection:
+    market_db = mongo_client.get_database(name='market')
+    return market_db.get_collection(name=JOURNAL_COLLECTION)
+
+
+def journal_rejections(mongo_client: MongoClient) -> dict[str, str]:
+    """Reason for every symbol the load rejected after fetching its bars"""
+    cursor = journal_collection(mongo_client=mongo_client).find(
+        filter={'status': REJECTED, 'reason': {'$ne': None}},
+        projection={'_id': False, 'symbol': True, 'reason': True})
+    return {entry['symbol']: entry['reason'] for entry in cursor}
+
+
+def latest_loaded_date(mongo_client: MongoClient) -> datetime:
+    """Most recent date written for any completed symbol"""
+    entry = journal_collection(mongo_client=mongo_client).find_one(
+        filter={'status': COMPLETED}, sort=[('last_date', DESCENDING)])
+    return None if entry is None else entry['last_date']
+
+
+def record_entries(mongo_client: MongoClient, entries: list[dict],
+                   now: datetime) -> None:
+    """Upsert one entry per symbol with a single bulk write"""
+    requests = [
+        ReplaceOne(
+            filter={'symbol': entry['symbol']},
+            replacement={**entry, 'updated': now}, upsert=True)
+        for entry in entries]
+    if requests:
+        journal_collection(mongo_client=mongo_client).bulk_write(
+            requests=requests, ordered=False)
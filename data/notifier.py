@@ -0,0 +1,105 @@
+"""Queued Telegram notifications sent as per-severity digests"""
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from typing import Callable
+
+from data.alpaca_client import TokenBucket
+from data.connections import send_message
+
+INFO = 'INFO'
+WARNING = 'WARNING'
+CRITICAL = 'CRITICAL'
+# Digest order, most severe first
+SEVERITIES = (WARNING, INFO)
+
+# Telegram allows about 20 messages per minute in one chat
+MESSAGES_PER_MINUTE = 20
+BURST_SIZE = 3
+DIGEST_SECONDS = 2.0
+MESSAGE_LIMIT = 4096
+
+
+class Notifier:
+    """Collect messages and send them from a background thread
+
+    Queued messages are coalesced into one digest per severity. Critical
+    messages skip the queue and are sent before notify returns.
+    """
+    def __init__(self, send: Callable[[str], None],
+                 bucket: TokenBucket, digest_seconds: float = DIGEST_SECONDS):
+        self.send = send
+        self.bucket = bucket
+        self.digest_seconds = digest_seconds
+        self.pending = Queue()
+        self.flush_requested = Event()
+        self.worker = None
+        self.lock = Lock()
+
+    def deliver(self, text: str) -> None:
+        """Send one message within the rate budget, never raising"""
+        self.bucket.acquire()
+        try:
+            self.send(text)
+        except Exception as err:
+            print('Telegram send failed: ' + repr(err) + '. Message: ' + text)
+
+    def flush(self) -> None:
+        """Block until every queued message has been sent"""
+        self.flush_requested.set()
+        self.pending.join()
+        self.flush_requested.clear()
+
+    def notify(self, text: str, severity: str = INFO) -> None:
+        if severity == CRITICAL:
+            self.deliver(text=text)
+            return
+        with self.lock:
+            # Threads are frozen between warm invocations, not stopped
+            if self.worker is None:
+                self.worker = Thread(target=self.run, daemon=True)
+                self.worker.start()
+        self.pending.put((severity, text))
+
+    def run(self) -> None:
+        while True:
+            batch = [self.pending.get()]
+            # Let more messages arrive unless the handler is exiting
+            self.flush_requested.wait(timeout=self.digest_seconds)
+            while True:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except Empty:
+                    break
+            try:
+                for severity in SEVERITIES:
+                    texts = [text for message_severity, text in batch
+                             if message_severity == severity]
+                    for digest in split_digest(severity=severity,
+                                               texts=texts):
+                        self.deliver(text=digest)
+            finally:
+                for _ in batch:
+                    self.pending.task_done()
+
+
+def split_digest(severity: str, texts: list[str]) -> list[str]:
+    """Join texts under a severity header, split at Telegram's size limit"""
+    if len(texts) <= 1:
+        return [text[:MESSAGE_LIMIT] for text in texts]
+    header = severity + ' digest (' + repr(len(texts)) + ' messages)'
+    digests = []
+    digest = header
+    for text in texts:
+        line = '\n- ' + text
+        if len(digest) + len(line) > MESSAGE_LIMIT and digest != header:
+            digests.append(digest)
+            digest = header
+        digest = (digest + line)[:MESSAGE_LIMIT]
+    digests.append(digest)
+    return digests
+
+
+notifier = Notifier(
+    send=send_message,
+    bucket=TokenBucket(
+        requests_per_minute=MESSAGES_PER_MINUTE, burst_size=BURST_SIZE))
@@ -0,0 +1,228 @@
+"""Streaming initial load with concurrent fetch, compute and write stages
+
+Threads download bars, a process pool builds indicator histories and the
+calling thread upserts them in batches, journaling each symbol once its
+rows are stored (see data/load_journal.py). A symbol takes one of IN_FLIGHT
+slots from the moment its fetch starts until the writer picks it up, and
+the writer holds at most WRITE_BATCH_SIZE documents, so memory stays flat
+however large the universe is.
+"""
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+import os
+from queue import Empty, Queue
+from threading import BoundedSemaphore, Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, NamedTuple
+
+from pymongo import MongoClient
+
+from data.latest_snapshot import replace_latest
+from data.load_journal import COMPLETED, FAILED, REJECTED, record_entries
+from data.storage import get_storage
+from data.tracked_asset import INSERT_BATCH_SIZE, TrackedAsset
+
+FETCH_WORKERS = 8
+COMPUTE_WORKERS = os.cpu_count() or 1
+# Symbols between the start of their fetch and their arrival at the writer
+IN_FLIGHT = 4 * (FETCH_WORKERS + COMPUTE_WORKERS)
+# Documents held by the writer before a flush
+WRITE_BATCH_SIZE = 20000
+# Rejected or failed symbols journaled together
+JOURNAL_BATCH_SIZE = 100
+PROGRESS_INTERVAL = 100
+# Seconds the writer waits for a symbol before checking the feed is alive
+STALL_SECONDS = 60
+
+
+class LoadSummary(NamedTuple):
+    tracked: int
+    rejected: int
+    failed: int
+
+
+class StageClock:
+    """Busy time summed over every worker of one stage"""
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.busy = 0.0
+        self.lock = Lock()
+
+    def add(self, seconds: float) -> None:
+        with self.lock:
+            self.busy += seconds
+
+    def report(self, elapsed: float) -> str:
+        utilization = self.busy / (elapsed * self.workers) if elapsed else 0.0
+        return (self.name + ' ' + '{:.0%}'.format(utilization) + ' of '
+                + repr(self.workers) + ' workers')
+
+
+class PipelineError(Exception):
+    pass
+
+
+def build_history(symbol: str, prices: list[float],
+                  dates: list[datetime]) -> tuple[list[dict], float]:
+    """Every stored document of one symbol and the seconds it took
+
+    Runs in a worker process, so it only touches its arguments.
+    """
+    started = perf_counter()
+    asset = TrackedAsset(symbol=symbol, date=dates[-1], close=prices[-1])
+    documents = asset.build_history(prices=prices, dates=dates)
+    return documents, perf_counter() - started
+
+
+def run_pipeline(symbols: list[str], fetch: Callable[[str], Any],
+                 mongo_client: MongoClient, now: datetime) -> LoadSummary:
+    """Load every symbol and journal how each one ended
+
+    fetch runs in threads and returns (prices, dates) to load, a rejection
+    reason, or None when there are no bars. A symbol whose fetch or
+    computation raises is journaled as failed and the load carries on. If
+    the thread feeding symbols dies, PipelineError is raised.
+    """
+    fetch_clock = StageClock(name='fetch', workers=FETCH_WORKERS)
+    compute_clock = StageClock(name='compute', workers=COMPUTE_WORKERS)
+    write_clock = StageClock(name='write', workers=1)
+    slots = BoundedSemaphore(IN_FLIGHT)
+    # One entry per symbol holding a slot, so puts never block
+    finished = Queue(maxsize=IN_FLIGHT)
+    storage = get_storage(mongo_client=mongo_client)
+
+    def timed_fetch(symbol: str) -> Any:
+        started = perf_counter()
+        try:
+            return fetch(symbol)
+        finally:
+            fetch_clock.add(perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as fetchers, \
+            ProcessPoolExecutor(
+                max_workers=COMPUTE_WORKERS,
+                mp_context=get_context('spawn')) as computers:
+
+        def fetched(symbol: str, future: Future) -> None:
+            try:
+                result = future.result()
+                if result is None or isinstance(result, str):
+                    finished.put((symbol, result, None))
+                    return
+                prices, dates = result
+                computed = computers.submit(
+                    build_history, symbol=symbol, prices=prices, dates=dates)
+            except Exception as err:
+                # Executors drop callback errors, and the writer would wait
+                # forever, so a broken pool fails the symbol instead
+                failure = Future()
+                failure.set_exception(err)
+                finished.put((symbol, None, failure))
+                return
+            computed.add_done_callback(
+                lambda done: finished.put((symbol, None, done)))
+
+        feed_errors = []
+
+        def feed() -> None:
+            try:
+                for symbol in symbols:
+                    # Blocks while IN_FLIGHT symbols wait further down
+                    slots.acquire()
+                    future = fetchers.submit(timed_fetch, symbol)
+                    future.add_done_callback(
+                        lambda done, symbol=symbol: fetched(symbol, done))
+            except BaseException as err:
+                feed_errors.append(err)
+                raise
+
+        feeder = Thread(target=feed, daemon=True)
+        feeder.start()
+
+        started = perf_counter()
+        tracked = 0
+        rejected = 0
+        failed = 0
+        pending = []
+        pending_documents = 0
+        # Journal entries of rejected and failed symbols not yet written
+        entries = []
+        for completed in range(1, len(symbols) + 1):
+            symbol, reason, future = next_finished(
+                finished=finished, feeder=feeder, feed_errors=feed_errors,
+                waiting=len(symbols) - completed + 1)
+            slots.release()
+            if future is None:
+                entries.append(
+                    {'symbol': symbol, 'status': REJECTED, 'reason': reason})
+                rejected += 1
+            else:
+                try:
+                    documents, seconds = future.result()
+                except Exception as err:
+                    print('Failed to load ' + symbol + ': ' + repr(err))
+                    entries.append({'symbol': symbol, 'status': FAILED,
+                                    'error': repr(err)})
+                    failed += 1
+                else:
+                    compute_clock.add(seconds)
+                    pending.append((symbol, documents))
+                    pending_documents += len(documents)
+            if (pending_documents >= WRITE_BATCH_SIZE
+                    or len(entries) >= JOURNAL_BATCH_SIZE
+                    or completed == len(symbols)):
+                write_started = perf_counter()
+                write_batch(storage=storage, mongo_client=mongo_client,
+                            batch=pending)
+                # Journal only once the rows it describes are stored
+                entries.extend(
+                    {'symbol': symbol, 'status': COMPLETED,
+                     'last_date': documents[-1]['date']}
+                    for symbol, documents in pending)
+                record_entries(
+                    mongo_client=mongo_client, entries=entries, now=now)
+                write_clock.add(perf_counter() - write_started)
+                for symbol, _ in pending:
+                    print(symbol)
+                tracked += len(pending)
+                pending = []
+                pending_documents = 0
+                entries = []
+            if completed % PROGRESS_INTERVAL == 0 or completed == len(symbols):
+                elapsed = perf_counter() - started
+                print('Progress: ' + repr(completed) + '/' + repr(len(symbols))
+                      + ' symbols, '
+                      + '{:.1f}'.format(completed / elapsed) + ' symbols/s, '
+                      + ', '.join(clock.report(elapsed=elapsed) for clock in (
+                          fetch_clock, compute_clock, write_clock)))
+    return LoadSummary(tracked=tracked, rejected=rejected, failed=failed)
+
+
+def next_finished(finished: Queue, feeder: Thread,
+                  feed_errors: list[BaseException], waiting: int) -> tuple:
+    """Next symbol for the writer, raising if none can ever arrive"""
+    while True:
+        try:
+            return finished.get(timeout=STALL_SECONDS)
+        except Empty:
+            if feed_errors:
+                raise PipelineError(
+                    'Feed stopped with ' + repr(waiting)
+                    + ' symbols unfinished') from feed_errors[0]
+            print('No symbol finished in ' + repr(STALL_SECONDS) + ' s, '
+                  + repr(waiting) + ' still waiting, feed '
+                  + ('running' if feeder.is_alive() else 'done'))
+
+
+def write_batch(storage, mongo_client: MongoClient,
+                batch: list[tuple[str, list[dict]]]) -> None:
+    """Upsert the histories of a batch of symbols and their snapshots"""
+    for symbol, documents in batch:
+        for start in range(0, len(documents), INSERT_BATCH_SIZE):
+            storage.replace_many(
+                symbol=symbol,
+                documents=documents[start:start + INSERT_BATCH_SIZE])
+    replace_latest(mongo_client=mongo_client,
+                   documents=[documents[-1] for _, documents in batch])
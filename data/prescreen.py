@@ -0,0 +1,125 @@
+"""Cheap universe screen run before downloading full histories
+
+Two short-window multi-symbol bar requests per batch rule out most of the
+universe: the recent window catches halted and illiquid symbols, and a
+window around the oldest day a tracked asset needs catches new listings.
+Rejections are stored so later loads skip those symbols without any request.
+"""
+from datetime import date, datetime, timedelta
+from typing import Any
+
+from alpaca.data.enums import Adjustment
+from alpaca.data.requests import StockBarsRequest
+from alpaca.data.timeframe import TimeFrame
+from pymongo import MongoClient, ReplaceOne
+from pymongo.collection import Collection
+
+from data.tracked_asset import INITIAL_DATA_POINTS, VOLUME_THRESHOLD
+
+REJECTIONS_COLLECTION = 'REJECTED'
+# Stored rejections are trusted for this long, then screened again
+REJECTION_TTL_DAYS = 30
+SCREEN_BATCH_SIZE = 200
+RECENT_WINDOW_DAYS = 20
+LISTING_WINDOW_DAYS = 10
+# Full-history average volume is rarely above 4x the recent average
+RECENT_VOLUME_FRACTION = 0.25
+
+HALTED = 'halted'
+ILLIQUID = 'illiquid'
+NEWLY_LISTED = 'newly_listed'
+RECENT_ZERO_VOLUME = 'recent_zero_volume'
+
+
+def fetch_window(client: Any, symbols: list[str], start: datetime,
+                 end: datetime) -> dict[str, list]:
+    """Daily bars of many symbols over a short window in one request"""
+    bars_request = StockBarsRequest(
+        symbol_or_symbols=symbols, start=start, end=end,
+        timeframe=TimeFrame.Day, adjustment=Adjustment.SPLIT)
+    try:
+        return client.get_stock_bars(request_params=bars_request).data
+    except AttributeError:
+        # Batches where no symbol traded come back empty
+        return {}
+
+
+def load_rejections(mongo_client: MongoClient,
+                    now: datetime) -> dict[str, str]:
+    """Reason for every symbol rejected within REJECTION_TTL_DAYS"""
+    since = now - timedelta(days=REJECTION_TTL_DAYS)
+    cursor = rejections_collection(mongo_client=mongo_client).find(
+        filter={'checked': {'$gte': since}}, projection={'_id': False})
+    return {rejection['symbol']: rejection['reason'] for rejection in cursor}
+
+
+def prescreen(client: Any, symbols: list[str],
+              trading_days: list[date]) -> dict[str, str]:
+    """Reason for every symbol ruled out by short-window bars
+
+    trading_days must end with the last completed session and hold at least
+    INITIAL_DATA_POINTS + LISTING_WINDOW_DAYS days.
+    """
+    recent_start = to_datetime(day=trading_days[-RECENT_WINDOW_DAYS])
+    recent_end = to_datetime(day=trading_days[-1]) + timedelta(days=1)
+    # A tracked asset needs more than INITIAL_DATA_POINTS bars
+    oldest_needed = -(INITIAL_DATA_POINTS + 1)
+    listing_start = to_datetime(
+        day=trading_days[oldest_needed - LISTING_WINDOW_DAYS + 1])
+    listing_end = to_datetime(day=trading_days[oldest_needed]) + timedelta(
+        days=1)
+
+    rejections = {}
+    for start in range(0, len(symbols), SCREEN_BATCH_SIZE):
+        batch = symbols[start:start + SCREEN_BATCH_SIZE]
+        recent = fetch_window(client=client, symbols=batch,
+                              start=recent_start, end=recent_end)
+        for symbol in batch:
+            reason = recent_reason(bars=recent.get(symbol, []))
+            if reason is not None:
+                rejections[symbol] = reason
+        # Only symbols still in the running need the listing window
+        remaining = [symbol for symbol in batch if symbol not in rejections]
+        if not remaining:
+            continue
+        listing = fetch_window(client=client, symbols=remaining,
+                               start=listing_start, end=listing_end)
+        for symbol in remaining:
+            if not listing.get(symbol):
+                rejections[symbol] = NEWLY_LISTED
+    return rejections
+
+
+def recent_reason(bars: list) -> str:
+    """Why recent bars rule a symbol out, or None if they do not"""
+    if not bars:
+        return HALTED
+    volumes = [candle.volume for candle in bars]
+    if 0 in volumes:
+        return RECENT_ZERO_VOLUME
+    if sum(volumes) / len(volumes) < VOLUME_THRESHOLD * RECENT_VOLUME_FRACTION:
+        return ILLIQUID
+    return None
+
+
+def record_rejections(mongo_client: MongoClient, rejections: dict[str, str],
+                      now: datetime) -> None:
+    """Upsert one rejection per symbol with a single bulk write"""
+    requests = [
+        ReplaceOne(
+            filter={'symbol': symbol},
+            replacement={'symbol': symbol, 'reason': reason, 'checked': now},
+            upsert=True)
+        for symbol, reason in rejections.items()]
+    if requests:
+        rejections_collection(mongo_client=mongo_client).bulk_write(
+            requests=requests, ordered=False)
+
+
+def rejections_collection(mongo_client: MongoClient) -> Collection:
+    market_db = mongo_client.get_database(name='market')
+    return market_db.get_collection(name=REJECTIONS_COLLECTION)
+
+
+def to_datetime(day: date) -> datetime:
+    return datetime.combine(date=day, time=datetime.min.time())
@@ -0,0 +1,268 @@
+"""Storage access for daily technical analysis history"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from os import environ
+from typing import Any, Iterator
+
+from pymongo import (
+    ASCENDING, DESCENDING, MongoClient, ReplaceOne, UpdateMany)
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.cursor import Cursor
+
+COLLECTIONS_LAYOUT = 'collections'
+UNIFIED_LAYOUT = 'unified'
+STORAGE_LAYOUT = environ.get('STOCK_STORAGE_LAYOUT', COLLECTIONS_LAYOUT)
+UNIFIED_DATABASE = 'history'
+UNIFIED_COLLECTION = 'DAILY'
+DUPLICATE_KEY_ERROR = 11000
+# Name MongoDB gives the date index of a symbol collection
+DATE_INDEX = 'date_1'
+INDEX_WORKERS = 16
+
+
+def date_filter(start: datetime = None, end: datetime = None) -> dict:
+    """Inclusive date range filter, open ended when a bound is None"""
+    bounds = {}
+    if start is not None:
+        bounds['$gte'] = start
+    if end is not None:
+        bounds['$lte'] = end
+    return {'date': bounds} if bounds else {}
+
+
+def duplicate_ids(collection: Collection,
+                  match: dict) -> dict[datetime, list[Any]]:
+    """Group matching rows by date on the server and return extra _ids"""
+    pipeline = [
+        {'$match': match},
+        # ObjectIds grow with insertion time, so the first _id is the oldest
+        {'$sort': {'_id': ASCENDING}},
+        {'$group': {'_id': '$date', 'ids': {'$push': '$_id'}}},
+        {'$match': {'ids.1': {'$exists': True}}}
+    ]
+    return {group['_id']: group['ids'][1:] for group
+            in collection.aggregate(pipeline=pipeline, allowDiskUse=True)}
+
+
+class SymbolCollectionStorage:
+    """Original layout: one collection per symbol in the stocks DB"""
+    def __init__(self, mongo_client: MongoClient):
+        self.stock_db = mongo_client.get_database(name='stocks')
+        # Symbols whose date index this instance has already ensured
+        self.indexed = set()
+
+    def append_documents(self, documents: list[dict]) -> None:
+        """Append rows, skipping any a failed earlier run already wrote"""
+        for document in documents:
+            try:
+                self.insert_one(document=document)
+            except DuplicateKeyError:
+                pass
+
+    def collection(self, symbol: str) -> Collection:
+        return self.stock_db.get_collection(name=symbol)
+
+    def dates_since(self, symbol: str, start: datetime) -> list[datetime]:
+        """Dates from start on, in the order the rows were inserted"""
+        cursor = self.collection(symbol=symbol).find(
+            filter={'date': {'$gte': start}},
+            projection={'_id': False, 'date': True}).sort('_id', ASCENDING)
+        return [document['date'] for document in cursor]
+
+    def delete_date(self, date: datetime) -> int:
+        return sum(
+            self.collection(symbol=symbol).delete_many(
+                filter={'date': date}).deleted_count
+            for symbol in self.symbols())
+
+    def delete_ids(self, symbol: str, ids: list[Any]) -> int:
+        return self.collection(symbol=symbol).delete_many(
+            filter={'_id': {'$in': ids}}).deleted_count
+
+    def drop_symbol(self, symbol: str) -> None:
+        self.stock_db.drop_collection(name_or_collection=symbol)
+
+    def duplicate_ids(self, symbol: str) -> dict[datetime, list[Any]]:
+        """_id of every extra copy of a date, keeping the first inserted"""
+        return duplicate_ids(
+            collection=self.collection(symbol=symbol), match={})
+
+    def ensure_index(self, symbol: str) -> None:
+        """Unique date index, replacing a plain one from older loads"""
+        collection = self.collection(symbol=symbol)
+        index = collection.index_information().get(DATE_INDEX)
+        if index is not None and not index.get('unique'):
+            collection.drop_index(index_or_name=DATE_INDEX)
+        collection.create_index(keys='date', unique=True)
+
+    def ensure_indexes(self) -> None:
+        with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+            # list() surfaces the first failure, e.g. remaining duplicates
+            list(executor.map(
+                lambda symbol: self.ensure_index(symbol=symbol),
+                self.symbols()))
+
+    def find_all_on_date(self, date: datetime) -> Iterator[dict]:
+        for symbol in self.symbols():
+            document = self.find_on_date(symbol=symbol, date=date)
+            if document is not None:
+                yield document
+
+    def find_on_date(self, symbol: str, date: datetime) -> dict:
+        return self.collection(symbol=symbol).find_one(filter={'date': date})
+
+    def history(self, symbol: str, start: datetime = None,
+                end: datetime = None, projection: dict = None) -> Cursor:
+        return self.collection(symbol=symbol).find(
+            filter=date_filter(start=start, end=end),
+            projection=projection).sort('date', ASCENDING)
+
+    def insert_one(self, document: dict) -> None:
+        self.collection(symbol=document['symbol']).insert_one(
+            document=document)
+
+    def latest(self, symbol: str) -> dict:
+        return self.collection(symbol=symbol).find_one(
+            sort=[('date', DESCENDING)])
+
+    def replace_many(self, symbol: str, documents: list[dict]) -> None:
+        """Upsert rows keyed on date, so writing them again is harmless"""
+        # Upserts look every row up by date, so index before the first one
+        if symbol not in self.indexed:
+            self.ensure_index(symbol=symbol)
+            self.indexed.add(symbol)
+        requests = [
+            ReplaceOne(filter={'date': document['date']},
+                       replacement=document, upsert=True)
+            for document in documents]
+        if requests:
+            self.collection(symbol=symbol).bulk_write(
+                requests=requests, ordered=False)
+
+    def rescale(self, ratios: dict[str, float], before: datetime,
+                fields: tuple[str, ...]) -> int:
+        """Multiply fields of every row dated before `before`, server side"""
+        return sum(
+            self.collection(symbol=symbol).update_many(
+                filter={'date': {'$lt': before}},
+                update={'$mul': {field: ratio for field in fields}}
+            ).modified_count
+            for symbol, ratio in ratios.items())
+
+    def symbols(self) -> list[str]:
+        return self.stock_db.list_collection_names()
+
+    def update_on_date(self, symbol: str, date: datetime,
+                       update: dict) -> None:
+        self.collection(symbol=symbol).update_one(
+            filter={'date': date}, update=update)
+
+
+class UnifiedStorage:
+    """Single collection keyed and indexed on (symbol, date)"""
+    def __init__(self, mongo_client: MongoClient):
+        history_db = mongo_client.get_database(name=UNIFIED_DATABASE)
+        self.collection = history_db.get_collection(name=UNIFIED_COLLECTION)
+
+    def append_documents(self, documents: list[dict]) -> None:
+        """Append one day of rows for many symbols in a single write
+
+        Rows a failed earlier run already wrote are skipped.
+        """
+        if not documents:
+            return
+        try:
+            self.collection.insert_many(documents=documents, ordered=False)
+        except BulkWriteError as bwe:
+            if any(write_error['code'] != DUPLICATE_KEY_ERROR
+                   for write_error in bwe.details['writeErrors']):
+                raise
+
+    def dates_since(self, symbol: str, start: datetime) -> list[datetime]:
+        """Dates from start on, in the order the rows were inserted"""
+        cursor = self.collection.find(
+            filter={'symbol': symbol, 'date': {'$gte': start}},
+            projection={'_id': False, 'date': True}).sort('_id', ASCENDING)
+        return [document['date'] for document in cursor]
+
+    def delete_date(self, date: datetime) -> int:
+        return self.collection.delete_many(
+            filter={'date': date}).deleted_count
+
+    def delete_ids(self, symbol: str, ids: list[Any]) -> int:
+        return self.collection.delete_many(
+            filter={'symbol': symbol, '_id': {'$in': ids}}).deleted_count
+
+    def drop_symbol(self, symbol: str) -> None:
+        self.collection.delete_many(filter={'symbol': symbol})
+
+    def duplicate_ids(self, symbol: str) -> dict[datetime, list[Any]]:
+        """_id of every extra copy of a date, keeping the first inserted"""
+        return duplicate_ids(
+            collection=self.collection, match={'symbol': symbol})
+
+    def ensure_indexes(self) -> None:
+        self.collection.create_index(
+            keys=[('symbol', ASCENDING), ('date', ASCENDING)], unique=True)
+        self.collection.create_index(
+            keys=[('date', ASCENDING), ('symbol', ASCENDING)])
+
+    def find_all_on_date(self, date: datetime) -> Iterator[dict]:
+        return self.collection.find(filter={'date': date})
+
+    def find_on_date(self, symbol: str, date: datetime) -> dict:
+        return self.collection.find_one(
+            filter={'symbol': symbol, 'date': date})
+
+    def history(self, symbol: str, start: datetime = None,
+                end: datetime = None, projection: dict = None) -> Cursor:
+        query = {'symbol': symbol, **date_filter(start=start, end=end)}
+        return self.collection.find(
+            filter=query, projection=projection).sort('date', ASCENDING)
+
+    def insert_one(self, document: dict) -> None:
+        self.collection.insert_one(document=document)
+
+    def latest(self, symbol: str) -> dict:
+        return self.collection.find_one(
+            filter={'symbol': symbol}, sort=[('date', DESCENDING)])
+
+    def replace_many(self, symbol: str, documents: list[dict]) -> None:
+        """Upsert rows keyed on (symbol, date) in one bulk write"""
+        requests = [
+            ReplaceOne(filter={'symbol': symbol, 'date': document['date']},
+                       replacement=document, upsert=True)
+            for document in documents]
+        if requests:
+            self.collection.bulk_write(requests=requests, ordered=False)
+
+    def rescale(self, ratios: dict[str, float], before: datetime,
+                fields: tuple[str, ...]) -> int:
+        """Multiply fields of rows dated before `before` in one bulk write"""
+        requests = [
+            UpdateMany(
+                filter={'symbol': symbol, 'date': {'$lt': before}},
+                update={'$mul': {field: ratio for field in fields}})
+            for symbol, ratio in ratios.items()]
+        if not requests:
+            return 0
+        return self.collection.bulk_write(
+            requests=requests, ordered=False).modified_count
+
+    def symbols(self) -> list[str]:
+        return self.collection.distinct(key='symbol')
+
+    def update_on_date(self, symbol: str, date: datetime,
+                       update: dict) -> None:
+        self.collection.update_one(
+            filter={'symbol': symbol, 'date': date}, update=update)
+
+
+def get_storage(mongo_client: MongoClient, layout: str = STORAGE_LAYOUT):
+    """Storage for the configured STOCK_STORAGE_LAYOUT"""
+    if layout == UNIFIED_LAYOUT:
+        return UnifiedStorage(mongo_client=mongo_client)
+    if layout == COLLECTIONS_LAYOUT:
+        return SymbolCollectionStorage(mongo_client=mongo_client)
+    raise ValueError('Unknown storage layout: ' + repr(layout))
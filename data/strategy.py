@@ -0,0 +1,90 @@
+"""Trading strategy thresholds and entry rules
+
+Entry rules are declared once and evaluated either over a feature matrix
+or over a mapping of feature columns, so live trading, screening and
+backtests cannot drift apart.
+"""
+from typing import Any, Mapping, NamedTuple
+
+import numpy as np
+
+MAX_OPEN_POSITIONS = 10
+STOP_LOSS_PERCENT = 10
+TARGET_PERCENT = 10
+TARGET_RSI = 30
+
+# Columns of a feature matrix, in order
+FEATURES = ('macd', 'macd_signal', 'rsi_min', 'rsi_max', 'trend_any',
+            'trend_all')
+
+
+class EntryRule(NamedTuple):
+    """MACD cross, RSI window threshold and trend window condition"""
+    side: str
+    # True requires macd > macd_signal, False requires macd < macd_signal
+    macd_above_signal: bool
+    # True requires an RSI above 100 - target_rsi, False one below target_rsi
+    rsi_above_threshold: bool
+    # True requires any close above trend, False any close below it
+    trend_above: bool
+
+    def evaluate(self, features: Mapping[str, Any], target_rsi: float):
+        """Apply the rule to scalar features or to whole feature columns"""
+        if self.macd_above_signal:
+            macd_crossed = features['macd'] > features['macd_signal']
+        else:
+            macd_crossed = features['macd'] < features['macd_signal']
+        if self.rsi_above_threshold:
+            rsi_reached = features['rsi_max'] > (100 - target_rsi)
+        else:
+            rsi_reached = features['rsi_min'] < target_rsi
+        if self.trend_above:
+            trend_matched = features['trend_any']
+        else:
+            trend_matched = np.logical_not(features['trend_all'])
+        return np.logical_and(
+            np.logical_and(macd_crossed, rsi_reached), trend_matched)
+
+    def mask(self, matrix: np.ndarray,
+             target_rsi: float = TARGET_RSI) -> np.ndarray:
+        """Evaluate every row of a (..., len(FEATURES)) matrix at once"""
+        with np.errstate(invalid='ignore'):
+            return self.evaluate(
+                features={name: matrix[..., column]
+                          for column, name in enumerate(FEATURES)},
+                target_rsi=target_rsi)
+
+
+LONG_ENTRY = EntryRule(side='long', macd_above_signal=True,
+                       rsi_above_threshold=False, trend_above=True)
+SHORT_ENTRY = EntryRule(side='short', macd_above_signal=False,
+                        rsi_above_threshold=True, trend_above=False)
+
+
+def document_features(document: dict) -> dict:
+    """Reduce the RSI and trend windows of a stored document to features
+
+    An empty trend window gives trend_any False and trend_all True, which
+    neither entry rule accepts.
+    """
+    rsi_min, rsi_max = window_extremes(window=document['rsi'])
+    return {'macd': document['macd'],
+            'macd_signal': document['macd_signal'],
+            'rsi_min': rsi_min,
+            'rsi_max': rsi_max,
+            'trend_any': any(document['trend']),
+            'trend_all': all(document['trend'])}
+
+
+def feature_matrix(documents: list[dict]) -> np.ndarray:
+    """Stack documents into a symbols x features matrix"""
+    rows = [[features[name] for name in FEATURES]
+            for features in map(document_features, documents)]
+    return np.array(rows, dtype=np.float64).reshape(-1, len(FEATURES))
+
+
+def window_extremes(window: list[float]) -> tuple[float, float]:
+    """Minimum and maximum skipping NaN, both NaN if nothing is left"""
+    values = np.asarray(window, dtype=np.float64)
+    return (float(np.fmin.reduce(values, initial=np.nan)),
+            float(np.fmax.reduce(values, initial=np.nan)))
@@ -1,27 +1,41 @@
 """Custom asset module for tracking technical analysis data"""
+from array import array
 from datetime import datetime
+from math import nan
 from typing import Any
 
 from pymongo import MongoClient
 
-EMA_BIG_LONG_PERIOD = 200
+from data.indicators import (
+    RSI_PERIOD, RSI_QUEUE, SMOOTH_9, SMOOTH_12, SMOOTH_26, SMOOTH_200,
+    TREND_QUEUE, compute_indicators, ema_big_long_series, macd_series,
+    rsi_series, window)
+from data.storage import get_storage
+
 INITIAL_DATA_POINTS = 250
-MACD_LONG_PERIOD = 26
-MACD_SHORT_PERIOD = 12
-MACD_SIGNAL_PERIOD = 9
-RSI_PERIOD = 14
-RSI_QUEUE = 5
-TREND_QUEUE = 20
+INSERT_BATCH_SIZE = 1000
 VOLUME_THRESHOLD = 5000000
-
-SMOOTH_9 = 0.2
-SMOOTH_12 = 0.153846153846
-SMOOTH_26 = 0.074074074074
-SMOOTH_200 = 0.0099502487562189
+# Reasons an asset is not tracked
+INSUFFICIENT_HISTORY = 'insufficient_history'
+LOW_VOLUME = 'low_volume'
+ZERO_VOLUME = 'zero_volume'
+# Document fields measured in price units, rescaled together on a split
+PRICE_FIELDS = ('close', 'ema_short', 'ema_long', 'macd', 'macd_signal',
+                'average_gains', 'average_losses', 'ema_big_long')
 
 
 class TrackedAsset:
-    """Custom asset class for tracking technical analysis data"""
+    """Custom asset class for tracking technical analysis data
+
+    The rsi window is a circular array and the trend window a bitmask with
+    the oldest value in the highest bit. Both are exposed as plain lists,
+    so stored documents keep their shape.
+    """
+    __slots__ = ('symbol', 'date', 'close', 'ema_short', 'ema_long', 'macd',
+                 'macd_signal', 'average_gains', 'average_losses',
+                 'rsi_values', 'rsi_start', 'ema_big_long', 'trend_bits',
+                 'trend_mask')
+
     def __init__(
             self, symbol: str, date: datetime, close: float,
             ema_short: float = 0.0, ema_long: float = 0.0,
@@ -38,15 +52,9 @@ class TrackedAsset:
         self.macd_signal = macd_signal
         self.average_gains = average_gains
         self.average_losses = average_losses
-        if rsi is None:
-            self.rsi = []
-        else:
-            self.rsi = rsi
+        self.rsi = [] if rsi is None else rsi
         self.ema_big_long = ema_big_long
-        if trend is None:
-            self.trend = []
-        else:
-            self.trend = trend
+        self.trend = [] if trend is None else trend
 
     def __repr__(self):
         return self.symbol
@@ -54,124 +62,180 @@ class TrackedAsset:
     def __str__(self):
         return self.symbol
 
+    @property
+    def rsi(self) -> list[float]:
+        start = self.rsi_start
+        return (self.rsi_values[start:] + self.rsi_values[:start]).tolist()
+
+    @rsi.setter
+    def rsi(self, values: list[float]) -> None:
+        self.rsi_values = array('d', values)
+        self.rsi_start = 0
+
+    @property
+    def trend(self) -> list[bool]:
+        return [bool(self.trend_bits >> shift & 1)
+                for shift in range(self.trend_mask.bit_length() - 1, -1, -1)]
+
+    @trend.setter
+    def trend(self, values: list[bool]) -> None:
+        self.trend_bits = 0
+        for value in values:
+            self.trend_bits = (self.trend_bits << 1) | bool(value)
+        self.trend_mask = (1 << len(values)) - 1
+
+    def build_history(self, prices: list, dates: list) -> list[dict]:
+        """Calculate all indicators and build every stored day's document"""
+        series = compute_indicators(closes=prices)
+        ema_short = series.ema_short.tolist()
+        ema_long = series.ema_long.tolist()
+        macd = series.macd.tolist()
+        macd_signal = series.macd_signal.tolist()
+        average_gains = series.average_gains.tolist()
+        average_losses = series.average_losses.tolist()
+        ema_big_long = series.ema_big_long.tolist()
+
+        documents = []
+        for i in range(INITIAL_DATA_POINTS, len(prices)):
+            self.date = dates[i]
+            self.close = prices[i]
+            self.ema_short = ema_short[i]
+            self.ema_long = ema_long[i]
+            self.macd = macd[i]
+            self.macd_signal = macd_signal[i]
+            self.average_gains = average_gains[i]
+            self.average_losses = average_losses[i]
+            self.rsi = window(series=series.rsi, index=i, length=RSI_QUEUE)
+            self.ema_big_long = ema_big_long[i]
+            self.trend = window(
+                series=series.above_trend, index=i, length=TREND_QUEUE)
+            documents.append(self.to_document())
+        return documents
+
+    def calculate_and_insert(self, prices: list, dates: list,
+                             mongo_client: MongoClient) -> None:
+        """Calculate all indicators and bulk upsert the full history"""
+        documents = self.build_history(prices=prices, dates=dates)
+        storage = get_storage(mongo_client=mongo_client)
+        for start in range(0, len(documents), INSERT_BATCH_SIZE):
+            storage.replace_many(
+                symbol=self.symbol,
+                documents=documents[start:start + INSERT_BATCH_SIZE])
+
     def calculate_ema_big_long(self, prices: list, dates: list,
                                mongo_client: MongoClient) -> None:
         """Calculate long-period trend line"""
-        self.ema_big_long = sum(
-            prices[0:EMA_BIG_LONG_PERIOD]) / EMA_BIG_LONG_PERIOD
-
-        for i in range(EMA_BIG_LONG_PERIOD, len(prices)):
-            self.ema_big_long = ((prices[i] - self.ema_big_long) * SMOOTH_200
-                                 + self.ema_big_long)
-            if i >= INITIAL_DATA_POINTS - TREND_QUEUE:
-                self.trend.append(prices[i] > self.ema_big_long)
-                if i >= INITIAL_DATA_POINTS:
-                    self.trend.pop(0)
-                    update = {
-                        '$set': {
-                            'ema_big_long': self.ema_big_long,
-                            'trend': self.trend
-                        }
-                    }
-                    self.update_db(
-                        filter_date=dates[i],
-                        update=update,
-                        mongo_client=mongo_client)
+        ema_big_long, above_trend = ema_big_long_series(closes=prices)
+
+        for i in range(INITIAL_DATA_POINTS, len(prices)):
+            update = {
+                '$set': {
+                    'ema_big_long': float(ema_big_long[i]),
+                    'trend': window(
+                        series=above_trend, index=i, length=TREND_QUEUE)
+                }
+            }
+            self.update_db(
+                filter_date=dates[i], update=update,
+                mongo_client=mongo_client)
+
+        self.ema_big_long = float(ema_big_long[-1])
+        self.trend = window(
+            series=above_trend, index=len(prices) - 1, length=TREND_QUEUE)
 
     def calculate_macd(self, prices: list, dates: list,
                        mongo_client: MongoClient) -> None:
         """Calculate MACD-related values"""
-        self.ema_short = sum(prices[0:MACD_SHORT_PERIOD]) / MACD_SHORT_PERIOD
-        self.ema_long = sum(prices[0:MACD_LONG_PERIOD]) / MACD_LONG_PERIOD
-        macd_signal_sum = 0.0
-
-        for i in range(MACD_SHORT_PERIOD, MACD_LONG_PERIOD):
-            self.ema_short = ((prices[i] - self.ema_short) * SMOOTH_12
-                              + self.ema_short)
-
-        for i in range(MACD_LONG_PERIOD, len(prices)):
-            self.ema_short = ((prices[i] - self.ema_short) * SMOOTH_12
-                              + self.ema_short)
-            self.ema_long = ((prices[i] - self.ema_long) * SMOOTH_26
-                             + self.ema_long)
-
-            if i < MACD_LONG_PERIOD + MACD_SIGNAL_PERIOD:
-                macd_signal_sum += self.ema_short - self.ema_long
-                if i == MACD_LONG_PERIOD + MACD_SIGNAL_PERIOD - 1:
-                    self.macd_signal = macd_signal_sum / MACD_SIGNAL_PERIOD
-            else:
-                self.macd_signal = (SMOOTH_9
-                                    * (self.ema_short
-                                       - self.ema_long
-                                       - self.macd_signal)
-                                    + self.macd_signal)
-
-            if i >= INITIAL_DATA_POINTS:
-                new_doc = {
-                    'symbol': self.symbol,
-                    'date': dates[i],
-                    'close': prices[i],
-                    'ema_short': self.ema_short,
-                    'ema_long': self.ema_long,
-                    'macd': self.ema_short - self.ema_long,
-                    'macd_signal': self.macd_signal
-                }
-                stock_db = mongo_client.get_database(name='stocks')
-                stock_collection = stock_db.get_collection(name=self.symbol)
-                stock_collection.insert_one(document=new_doc)
+        ema_short, ema_long, macd, macd_signal = macd_series(closes=prices)
+
+        documents = []
+        for i in range(INITIAL_DATA_POINTS, len(prices)):
+            documents.append({
+                'symbol': self.symbol,
+                'date': dates[i],
+                'close': prices[i],
+                'ema_short': float(ema_short[i]),
+                'ema_long': float(ema_long[i]),
+                'macd': float(macd[i]),
+                'macd_signal': float(macd_signal[i])
+            })
+        # Upserts keyed on date, so a rerun replaces rows instead of adding
+        get_storage(mongo_client=mongo_client).replace_many(
+            symbol=self.symbol, documents=documents)
 
-        self.macd = self.ema_short - self.ema_long
+        self.ema_short = float(ema_short[-1])
+        self.ema_long = float(ema_long[-1])
+        self.macd = float(macd[-1])
+        self.macd_signal = float(macd_signal[-1])
 
     def calculate_rsi(self, prices: list, dates: list,
                       mongo_client: MongoClient) -> None:
         """Calculate RSI-related values"""
-        sum_gains = 0.0
-        sum_losses = 0.0
-
-        for i in range(RSI_PERIOD):
-            change = prices[i+1] - prices[i]
-
-            if change >= 0:
-                sum_gains += change
-            else:
-                sum_losses -= change
-
-        self.average_gains = sum_gains / RSI_PERIOD
-        self.average_losses = sum_losses / RSI_PERIOD
-
-        for i in range(RSI_PERIOD, len(prices) - 1):
-            change = prices[i+1] - prices[i]
-            self.update_gains_and_losses(change)
-
-            if i >= (INITIAL_DATA_POINTS - RSI_QUEUE - 1):
-                rsi_value = 100 - 100 / (
-                    1 + self.average_gains / self.average_losses)
-                self.rsi.append(rsi_value)
-                if i >= (INITIAL_DATA_POINTS - 1):
-                    self.rsi.pop(0)
-                    update = {
-                        '$set': {
-                            'average_gains': self.average_gains,
-                            'average_losses': self.average_losses,
-                            'rsi': self.rsi
-                        }
-                    }
-                    self.update_db(
-                        filter_date=dates[i+1],
-                        update=update,
-                        mongo_client=mongo_client)
+        average_gains, average_losses, rsi = rsi_series(closes=prices)
+
+        for i in range(INITIAL_DATA_POINTS, len(prices)):
+            update = {
+                '$set': {
+                    'average_gains': float(average_gains[i]),
+                    'average_losses': float(average_losses[i]),
+                    'rsi': window(series=rsi, index=i, length=RSI_QUEUE)
+                }
+            }
+            self.update_db(
+                filter_date=dates[i], update=update,
+                mongo_client=mongo_client)
+
+        self.average_gains = float(average_gains[-1])
+        self.average_losses = float(average_losses[-1])
+        self.rsi = window(series=rsi, index=len(prices) - 1, length=RSI_QUEUE)
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'TrackedAsset':
+        """Restore incremental state from a stored daily document"""
+        return cls(
+            symbol=document['symbol'], date=document['date'],
+            close=document['close'], ema_short=document['ema_short'],
+            ema_long=document['ema_long'], macd=document['macd'],
+            macd_signal=document['macd_signal'],
+            average_gains=document['average_gains'],
+            average_losses=document['average_losses'], rsi=document['rsi'],
+            ema_big_long=document['ema_big_long'], trend=document['trend'])
 
     @staticmethod
     def has_enough_trades(bars: list[Any]) -> bool:
         """Check if trade data meets volume and timeframe thresholds"""
+        return TrackedAsset.rejection_reason(bars) is None
+
+    @staticmethod
+    def rejection_reason(bars: list[Any]) -> str:
+        """Why the bars fail has_enough_trades, or None if they pass"""
         if (len(bars) <= INITIAL_DATA_POINTS):
-            return False
+            return INSUFFICIENT_HISTORY
         volumes = [candle.volume for candle in bars]
         # Do not consider any assets that left the market for any time
         if 0 in volumes:
-            return False
+            return ZERO_VOLUME
         average_volume = sum(volumes) / len(volumes)
-        return average_volume >= VOLUME_THRESHOLD
+        if average_volume < VOLUME_THRESHOLD:
+            return LOW_VOLUME
+        return None
+
+    def to_document(self) -> dict:
+        """Serialize current state into a stored daily document"""
+        return {
+            'symbol': self.symbol,
+            'date': self.date,
+            'close': self.close,
+            'ema_short': self.ema_short,
+            'ema_long': self.ema_long,
+            'macd': self.macd,
+            'macd_signal': self.macd_signal,
+            'average_gains': self.average_gains,
+            'average_losses': self.average_losses,
+            'rsi': self.rsi,
+            'ema_big_long': self.ema_big_long,
+            'trend': self.trend
+        }
 
     def update_gains_and_losses(self, change: float) -> None:
         """Common logic to update RSI-related values"""
@@ -189,30 +253,40 @@ class TrackedAsset:
     def update_db(
             self, filter_date: datetime, update: dict,
             mongo_client: MongoClient) -> None:
-        stock_db = mongo_client.get_database(name='stocks')
-        collection = stock_db.get_collection(name=self.symbol)
-        collection.update_one(filter={'date': filter_date}, update=update)
+        get_storage(mongo_client=mongo_client).update_on_date(
+            symbol=self.symbol, date=filter_date, update=update)
 
     def update_stats(self, new_price: float, new_date: datetime) -> None:
         """Update technical analysis data"""
-        self.ema_short = ((new_price - self.ema_short) * SMOOTH_12
-                          + self.ema_short)
-        self.ema_long = ((new_price - self.ema_long) * SMOOTH_26
-                         + self.ema_long)
-        self.macd = self.ema_short - self.ema_long
-        self.macd_signal = ((self.macd - self.macd_signal) * SMOOTH_9
+        ema_short = (new_price - self.ema_short) * SMOOTH_12 + self.ema_short
+        ema_long = (new_price - self.ema_long) * SMOOTH_26 + self.ema_long
+        macd = ema_short - ema_long
+        self.ema_short = ema_short
+        self.ema_long = ema_long
+        self.macd = macd
+        self.macd_signal = ((macd - self.macd_signal) * SMOOTH_9
                             + self.macd_signal)
 
         change = new_price - self.close
         self.update_gains_and_losses(change=change)
-        self.rsi.pop(0)
-        rsi_value = 100 - 100 / (1 + self.average_gains / self.average_losses)
-        self.rsi.append(rsi_value)
-
-        self.ema_big_long = ((new_price - self.ema_big_long) * SMOOTH_200
-                             + self.ema_big_long)
-        self.trend.pop(0)
-        self.trend.append(new_price > self.ema_big_long)
+        average_gains = self.average_gains
+        average_losses = self.average_losses
+        if average_losses:
+            rsi_value = 100 - 100 / (1 + average_gains / average_losses)
+        else:
+            # Same result the vectorized engine gets from float division
+            rsi_value = 100.0 if average_gains else nan
+        # Overwrite the oldest value instead of shifting the window
+        start = self.rsi_start
+        self.rsi_values[start] = rsi_value
+        start += 1
+        self.rsi_start = 0 if start == len(self.rsi_values) else start
+
+        ema_big_long = ((new_price - self.ema_big_long) * SMOOTH_200
+                        + self.ema_big_long)
+        self.ema_big_long = ema_big_long
+        self.trend_bits = ((self.trend_bits << 1 | (new_price > ema_big_long))
+                           & self.trend_mask)
 
         self.date = new_date
         self.close = new_price
@@ -3,17 +3,16 @@ from os import environ
 
 from pymongo import MongoClient
 
+from data.storage import get_storage
+
 mongo_client = MongoClient(environ.get('MONGO_CONNECTION_STRING'))
-stock_db = mongo_client.get_database(name='stocks')
+storage = get_storage(mongo_client=mongo_client)
 
 market_db = mongo_client.get_database(name='market')
 market_collection = market_db.get_collection(name='MARKET_DATA')
 market_item = market_collection.find_one()
 latest_date = market_item['latest_date']
 
-for asset_collection_name in stock_db.list_collection_names():
-    asset_collection = stock_db.get_collection(name=asset_collection_name)
-    thefilter = {'date': latest_date}
-    print(asset_collection.delete_many(filter=thefilter).deleted_count)
+print(storage.delete_date(date=latest_date))
 
 mongo_client.close()
@@ -1,22 +1,55 @@
-"""Traverse stock DB and delete duplicate data"""
+"""Delete every duplicated (symbol, date) row, then enforce unique dates
+
+Usage: python delete_duplicate_dates.py [--dry-run]
+
+Duplicates are found with a server-side aggregation per symbol, run
+concurrently, and each symbol's extra copies are removed in one delete.
+The oldest copy of each date is kept. With --dry-run nothing is deleted
+and no index is created.
+"""
+from concurrent.futures import ThreadPoolExecutor
 from os import environ
+import sys
+from time import perf_counter
 
 from pymongo import MongoClient
 
+from data.storage import get_storage
+
+WORKERS = 16
+
 mongo_client = MongoClient(environ.get('MONGO_CONNECTION_STRING'))
-stock_db = mongo_client.get_database(name='stocks')
-
-for asset_collection_name in stock_db.list_collection_names():
-    asset_collection = stock_db.get_collection(name=asset_collection_name)
-    dates = set()
-    delete = False
-    for asset_item in asset_collection.find():
-        if asset_item['date'] in dates:
-            delete = True
-            delete_date = asset_item['date']
-        else:
-            dates.add(asset_item['date'])
-    if delete:
-        asset_collection.delete_one(filter={'date': delete_date})
+storage = get_storage(mongo_client=mongo_client)
+dry_run = '--dry-run' in sys.argv
+
+
+def repair_symbol(symbol: str) -> tuple[str, int, int]:
+    """Duplicated dates and extra copies found (and deleted) for symbol"""
+    duplicates = storage.duplicate_ids(symbol=symbol)
+    ids = [extra_id for extra_ids in duplicates.values()
+           for extra_id in extra_ids]
+    if ids and not dry_run:
+        storage.delete_ids(symbol=symbol, ids=ids)
+    if duplicates:
+        print(symbol + ': ' + repr(len(duplicates)) + ' dates, '
+              + repr(len(ids)) + ' extra copies, first '
+              + min(duplicates).strftime('%Y-%m-%d'))
+    return symbol, len(duplicates), len(ids)
+
+
+started = perf_counter()
+symbols = storage.symbols()
+with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+    results = list(executor.map(repair_symbol, symbols))
 
+affected = sum(1 for _, dates, _ in results if dates)
+copies = sum(extra for _, _, extra in results)
+print(('Would delete ' if dry_run else 'Deleted ') + repr(copies)
+      + ' extra copies in ' + repr(affected) + ' of ' + repr(len(symbols))
+      + ' symbols')
+if not dry_run:
+    # Duplicates cannot come back once dates are unique
+    storage.ensure_indexes()
+    print('Unique date indexes in place')
+print('Finished in ' + '{:.1f}'.format(perf_counter() - started) + ' s')
 mongo_client.close()
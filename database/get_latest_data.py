@@ -1,35 +1,76 @@
-"""Display latest technical analysis data for a given symbol"""
-from datetime import date, datetime, timedelta
+"""Display technical analysis data for one or more symbols
+
+Usage: python get_latest_data.py SYMBOL [SYMBOL ...] [--start YYYY-MM-DD]
+           [--end YYYY-MM-DD] [--fields FIELD ...] [--csv]
+
+Without a date range, prints each symbol's most recent row. With --start
+or --end, streams every row in the inclusive range. Either way each
+symbol costs one indexed query.
+"""
+from argparse import ArgumentParser
+import csv
+from datetime import datetime
 from os import environ
 import sys
 
 from pymongo import MongoClient
 
-if len(sys.argv) != 2:
-    print('Usage: python get_latest_data.py <SYMBOL>')
-    exit()
-else:
-    symbol = sys.argv[1].upper()
+from data.storage import get_storage
+
+DEFAULT_FIELDS = ['close', 'macd', 'macd_signal', 'rsi', 'ema_big_long']
+# Window fields are shown as their newest value
+WINDOW_FIELDS = ('rsi', 'trend')
+CURSOR_BATCH_SIZE = 1000
+COLUMN_WIDTH = 14
+
+
+def parse_date(text: str) -> datetime:
+    return datetime.strptime(text, '%Y-%m-%d')
+
+
+def print_table_row(row: list[str]) -> None:
+    print(''.join(value.rjust(COLUMN_WIDTH) for value in row))
+
+
+def to_row(document: dict, fields: list[str]) -> list[str]:
+    row = [document['symbol'], document['date'].strftime('%Y-%m-%d')]
+    for field in fields:
+        value = document.get(field)
+        if field in WINDOW_FIELDS and value:
+            value = value[-1]
+        row.append('' if value is None else str(value))
+    return row
+
+
+parser = ArgumentParser()
+parser.add_argument('symbols', nargs='+', metavar='SYMBOL')
+parser.add_argument('--start', type=parse_date)
+parser.add_argument('--end', type=parse_date)
+parser.add_argument('--fields', nargs='+', default=DEFAULT_FIELDS)
+parser.add_argument('--csv', action='store_true',
+                    help='write CSV instead of an aligned table')
+args = parser.parse_args()
 
 mongo_client = MongoClient(environ.get('MONGO_CONNECTION_STRING'))
-stock_db = mongo_client.get_database(name='stocks')
-asset_collection = stock_db.get_collection(name=symbol)
-
-target_date = datetime.combine(
-    date=date.today(), time=datetime.min.time())
-asset_item = asset_collection.find_one(filter={'date': target_date})
-
-if asset_item is None:
-    print('Couldn\'t find data for today. Printing most recent data...')
-    while asset_item is None:
-        target_date -= timedelta(days=1)
-        asset_item = asset_collection.find_one(filter={'date': target_date})
-
-print('Symbol: ' + asset_item['symbol'])
-print('Date: ' + str(asset_item['date']))
-print('Close: ' + str(asset_item['close']))
-print('MACD: ' + str(asset_item['macd']))
-print('MACD_SIGNAL: ' + str(asset_item['macd_signal']))
-print('RSI: ' + str(asset_item['rsi'][len(asset_item['rsi']) - 1]))
-print('BIG_EMA: ' + str(asset_item['ema_big_long']))
+storage = get_storage(mongo_client=mongo_client)
+projection = {'_id': False, 'symbol': True, 'date': True,
+              **{field: True for field in args.fields}}
+
+write_row = csv.writer(sys.stdout).writerow if args.csv else print_table_row
+
+write_row(['symbol', 'date', *args.fields])
+for symbol in (symbol.upper() for symbol in args.symbols):
+    if args.start is None and args.end is None:
+        # Sorted on the date index and limited to one row
+        asset_item = storage.latest(symbol=symbol)
+        if asset_item is None:
+            print('No data stored for: ' + symbol, file=sys.stderr)
+            continue
+        write_row(to_row(document=asset_item, fields=args.fields))
+        continue
+    cursor = storage.history(
+        symbol=symbol, start=args.start, end=args.end,
+        projection=projection).batch_size(CURSOR_BATCH_SIZE)
+    for document in cursor:
+        write_row(to_row(document=document, fields=args.fields))
 mongo_client.close()
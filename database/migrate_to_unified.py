@@ -0,0 +1,42 @@
+"""Copy per-symbol stock collections into the unified history collection
+
+Usage: python migrate_to_unified.py [--drop]
+"""
+from os import environ
+import sys
+
+from pymongo import MongoClient
+
+from data.storage import COLLECTIONS_LAYOUT, UNIFIED_LAYOUT, get_storage
+
+BATCH_SIZE = 1000
+
+mongo_client = MongoClient(environ.get('MONGO_CONNECTION_STRING'))
+source = get_storage(mongo_client=mongo_client, layout=COLLECTIONS_LAYOUT)
+target = get_storage(mongo_client=mongo_client, layout=UNIFIED_LAYOUT)
+drop_source = '--drop' in sys.argv
+
+# Unique (symbol, date) index makes reruns skip already copied rows
+target.ensure_indexes()
+error = False
+for symbol in source.symbols():
+    documents = list(source.history(symbol=symbol, projection={'_id': False}))
+    for start in range(0, len(documents), BATCH_SIZE):
+        # Rows an earlier run already copied are skipped
+        target.append_documents(
+            documents=documents[start:start + BATCH_SIZE])
+
+    migrated = sum(1 for _ in target.history(
+        symbol=symbol, projection={'_id': False, 'date': True}))
+    if migrated != len({document['date'] for document in documents}):
+        print('Count mismatch for: ' + symbol + '. Source: '
+              + repr(len(documents)) + '. Unified: ' + repr(migrated))
+        error = True
+        continue
+    print(symbol + ': ' + repr(migrated))
+    if drop_source:
+        source.drop_symbol(symbol=symbol)
+
+if not error:
+    print('Migration complete. Set STOCK_STORAGE_LAYOUT=unified to use it')
+mongo_client.close()
@@ -1,51 +1,37 @@
 """Display any upcoming entry signals"""
-from datetime import date, datetime, timedelta
 from os import environ
 
+import numpy as np
 from pymongo import MongoClient
 
-TARGET_RSI = 30
+from data.latest_snapshot import latest_collection
+from data.strategy import LONG_ENTRY, SHORT_ENTRY, feature_matrix
 
 mongo_client = MongoClient(environ.get('MONGO_CONNECTION_STRING'))
-stock_db = mongo_client.get_database(name='stocks')
+market_db = mongo_client.get_database(name='market')
+market_collection = market_db.get_collection(name='MARKET_DATA')
+latest_date = market_collection.find_one()['latest_date']
+asset_items = []
 
-today = datetime.combine(
-    date=date.today(), time=datetime.min.time())
-long_signals = []
-short_signals = []
-
-for symbol in stock_db.list_collection_names():
-    asset_collection = stock_db.get_collection(name=symbol)
-    asset_item = asset_collection.find_one(filter={'date': today})
-    counter = 0
-    while asset_item is None and counter < 3:
-        today -= timedelta(days=1)
-        counter += 1
-        asset_item = asset_collection.find_one(filter={'date': today})
-    if asset_item is None:
-        print('No data found for: ' + symbol)
+# Single cursor over the latest snapshot of every symbol
+for asset_item in latest_collection(mongo_client=mongo_client).find(
+        projection={'_id': False}):
+    if asset_item['date'] != latest_date:
+        print('No data found for: ' + asset_item['symbol'])
         print('Abort!')
         break
-    if asset_item['macd'] > asset_item['macd_signal']:
-        filtered_rsi = [rsi_value for rsi_value in asset_item['rsi']
-                        if rsi_value < TARGET_RSI]
-        if filtered_rsi:
-            filtered_trend = [
-                trend_value for trend_value in asset_item['trend']
-                if trend_value]
-            if filtered_trend:
-                print('Long signal: ' + symbol)
-                long_signals.append(asset_item)
-    elif asset_item['macd'] < asset_item['macd_signal']:
-        filtered_rsi = [rsi_value for rsi_value in asset_item['rsi']
-                        if rsi_value > (100 - TARGET_RSI)]
-        if filtered_rsi:
-            filtered_trend = [
-                trend_value for trend_value in asset_item['trend']
-                if not trend_value]
-            if filtered_trend:
-                print('Short signal: ' + symbol)
-                short_signals.append(asset_item)
+    asset_items.append(asset_item)
+
+# Whole universe screened with one array operation per rule
+features = feature_matrix(documents=asset_items)
+long_signals = [asset_items[row]
+                for row in np.flatnonzero(LONG_ENTRY.mask(matrix=features))]
+short_signals = [asset_items[row]
+                 for row in np.flatnonzero(SHORT_ENTRY.mask(matrix=features))]
+for asset_item in long_signals:
+    print('Long signal: ' + asset_item['symbol'])
+for asset_item in short_signals:
+    print('Short signal: ' + asset_item['symbol'])
 if long_signals:
     print('Long Signals:')
     print(long_signals)
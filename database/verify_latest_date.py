@@ -1,30 +1,115 @@
-"""Verify all records have the same latest date"""
+"""Verify every symbol's recent history against the trading calendar
+
+Usage: python verify_latest_date.py [--sessions N]
+
+Each symbol's last N sessions up to the market latest_date are read with
+one indexed range query per symbol, fanned out over a thread pool. A
+symbol fails when its tail is missing a session, has a date twice, has a
+date that is not a session, or has rows inserted out of date order.
+Problems are printed per symbol, followed by a one-line JSON summary.
+Exits with status 1 if any symbol fails.
+"""
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import json
 from os import environ
+import sys
+from time import perf_counter
 
+from alpaca.trading.requests import GetCalendarRequest
 from pymongo import MongoClient
 
+from data.alpaca_client import trading_client
+from data.storage import get_storage
+
+TAIL_SESSIONS = 20
+WORKERS = 16
+
+
+def check_symbol(symbol: str) -> dict:
+    """Problems in one symbol's tail, empty if there are none"""
+    dates = storage.dates_since(symbol=symbol, start=sessions[0])
+    present = set(dates)
+    problems = {}
+    missing = [session for session in sessions if session not in present]
+    if missing:
+        problems['missing'] = missing
+    duplicates = sorted(
+        date for date, count in Counter(dates).items() if count > 1)
+    if duplicates:
+        problems['duplicates'] = duplicates
+    unexpected = sorted(present - session_set)
+    if unexpected:
+        problems['unexpected'] = unexpected
+    out_of_order = [later for earlier, later in zip(dates, dates[1:])
+                    if later < earlier]
+    if out_of_order:
+        problems['out_of_order'] = out_of_order
+    return problems
+
+
+def format_dates(dates: list[datetime]) -> list[str]:
+    return [date.strftime('%Y-%m-%d') for date in dates]
+
+
+parser = ArgumentParser()
+parser.add_argument('--sessions', type=int, default=TAIL_SESSIONS,
+                    help='trading sessions to check, ending at latest_date')
+args = parser.parse_args()
+
+started = perf_counter()
 mongo_client = MongoClient(environ.get('MONGO_CONNECTION_STRING'))
 market_db = mongo_client.get_database(name='market')
-stock_db = mongo_client.get_database(name='stocks')
+storage = get_storage(mongo_client=mongo_client)
 market_collection = market_db.get_collection(name='MARKET_DATA')
 market_item = market_collection.find_one()
-
 latest_date = market_item['latest_date']
 print(latest_date)
-error = False
-for symbol in stock_db.list_collection_names():
-    asset_collection = stock_db.get_collection(name=symbol)
-    asset_items = asset_collection.find(filter={'date': latest_date})
-    item_count = 0
-    # Is there a better way to determine number of items in cursor?
-    for asset_item in asset_items:
-        item_count += 1
-    if item_count > 1:
-        print('Duplicate data detected: ' + symbol)
-        error = True
-    elif item_count < 1:
-        print('No data for: ' + symbol)
-        error = True
-if not error:
+
+alpaca_trading_client = trading_client(
+    api_key=environ.get('APCA_API_KEY_ID'),
+    secret_key=environ.get('APCA_API_SECRET_KEY'), paper=False)
+# Two calendar days per session leaves room for weekends and holidays
+calendar_request = GetCalendarRequest(
+    start=latest_date - timedelta(days=2 * args.sessions + 7),
+    end=latest_date)
+sessions = [
+    datetime.combine(date=session.date, time=datetime.min.time())
+    for session in alpaca_trading_client.get_calendar(
+        filters=calendar_request)][-args.sessions:]
+session_set = set(sessions)
+
+symbols = storage.symbols()
+with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+    results = dict(zip(symbols, executor.map(check_symbol, symbols)))
+
+summary = {
+    'latest_date': latest_date.strftime('%Y-%m-%d'),
+    'first_session': sessions[0].strftime('%Y-%m-%d'),
+    'sessions': len(sessions),
+    'symbols': len(symbols),
+    'failed': 0
+}
+for problem in ('missing', 'duplicates', 'unexpected', 'out_of_order'):
+    summary[problem] = {}
+for symbol, problems in results.items():
+    if not problems:
+        continue
+    summary['failed'] += 1
+    for problem, dates in problems.items():
+        summary[problem][symbol] = format_dates(dates=dates)
+        print(symbol + ' ' + problem + ': '
+              + ', '.join(format_dates(dates=dates)))
+summary['missing_latest'] = sorted(
+    symbol for symbol, problems in results.items()
+    if latest_date in problems.get('missing', []))
+summary['seconds'] = round(perf_counter() - started, 2)
+
+if not summary['failed']:
     print('Data successfully validated')
+print(json.dumps(summary, sort_keys=True))
 mongo_client.close()
+if summary['failed']:
+    sys.exit(1)
@@ -1,99 +1,167 @@
-"""Perform initial dataload"""
-from datetime import date, datetime
+"""Perform initial dataload
+
+Usage: python initial_dataload.py [--rescreen] [--resume]
+
+Symbols rejected by an earlier run are skipped unless --rescreen is given.
+With --resume, symbols the interrupted run already completed or rejected
+are skipped and failed ones are retried.
+Bars are fetched, indicators computed and histories written concurrently,
+see data/pipeline.py.
+"""
+from datetime import date, datetime, timedelta
+from functools import partial
 from os import environ
-from time import sleep
+import sys
+from typing import Any
 
 from alpaca.data.enums import Adjustment
-from alpaca.data.historical.stock import StockHistoricalDataClient
 from alpaca.data.requests import StockBarsRequest
 from alpaca.data.timeframe import TimeFrame
-from alpaca.trading.client import TradingClient
 from alpaca.trading.enums import AssetClass, AssetExchange, AssetStatus
-from alpaca.trading.requests import GetAssetsRequest
+from alpaca.trading.requests import GetAssetsRequest, GetCalendarRequest
 from pymongo import MongoClient
 
+from data.alpaca_client import CALL_COUNTS, historical_client, trading_client
+from data.bar_cache import BAR_CACHE_OFFLINE, fetch_with_cache, get_bar_cache
+from data.latest_snapshot import ensure_index
+from data.load_journal import (
+    clear_journal, finished_symbols, journal_rejections, latest_loaded_date)
+from data.pipeline import run_pipeline
+from data.prescreen import load_rejections, prescreen, record_rejections
+from data.storage import get_storage
 from data.tracked_asset import TrackedAsset
 
-tracked_assets = []
+# Calendar days covering enough sessions for the pre-screen windows
+SCREEN_CALENDAR_DAYS = 550
 
-alpaca_historical_client = StockHistoricalDataClient(
-    api_key=environ.get('APCA_API_KEY_ID'),
-    secret_key=environ.get('APCA_API_SECRET_KEY'))
-alpaca_trading_client = TradingClient(
-    api_key=environ.get('APCA_API_KEY_ID'),
-    secret_key=environ.get('APCA_API_SECRET_KEY'), paper=False)
-mongo_client = MongoClient(environ.get('MONGO_CONNECTION_STRING'))
 
-
-def import_asset(symbol: str, start_date: datetime,
-                 end_date: datetime) -> bool:
-    """Fetch and ingest data for given stock symbol"""
-    bars_request = StockBarsRequest(
-        symbol_or_symbols=symbol, start=start_date, end=end_date,
-        timeframe=TimeFrame.Day, adjustment=Adjustment.SPLIT)
+def fetch_bars(symbol: str, start_date: datetime,
+               end_date: datetime) -> list:
+    """Fetch full daily history for given stock symbol"""
     try:
+        if bar_cache is not None:
+            # Only the range missing from the local cache is downloaded
+            bars = fetch_with_cache(
+                cache=bar_cache, client=alpaca_historical_client,
+                symbol=symbol, start=start_date, end=end_date)
+            return bars if bars else None
+        bars_request = StockBarsRequest(
+            symbol_or_symbols=symbol, start=start_date, end=end_date,
+            timeframe=TimeFrame.Day, adjustment=Adjustment.SPLIT)
         bars_response = alpaca_historical_client.get_stock_bars(
             request_params=bars_request)
     except AttributeError:
         # A few problematic NASDAQ stocks exist at time of commit
         print('Swallowing empty response for: ' + symbol)
-        return False
-    bars = bars_response.data[symbol]
-
-    latest_bar = bars[-1]
-    latest_date = latest_bar.timestamp.replace(
-        hour=0, minute=0, second=0, microsecond=0)
-    asset = TrackedAsset(
-        symbol=symbol, date=latest_date, close=latest_bar.close)
-
-    if not asset.has_enough_trades(bars):
-        return False
-
+        return None
+    return bars_response.data[symbol]
+
+
+def fetch_history(symbol: str, start_date: datetime,
+                  end_date: datetime) -> Any:
+    """Closing prices and dates, the rejection reason, or None if no bars"""
+    bars = fetch_bars(symbol=symbol, start_date=start_date, end_date=end_date)
+    if bars is None:
+        return None
+    reason = TrackedAsset.rejection_reason(bars)
+    if reason is not None:
+        return reason
     prices = [candle.close for candle in bars]
     dates = [candle.timestamp.replace(
         hour=0, minute=0, second=0, microsecond=0) for candle in bars]
-
-    # This ordering of methods matters now for DB calls
-    asset.calculate_macd(prices=prices, dates=dates, mongo_client=mongo_client)
-    asset.calculate_rsi(prices=prices, dates=dates, mongo_client=mongo_client)
-    asset.calculate_ema_big_long(
-        prices=prices, dates=dates, mongo_client=mongo_client)
-    tracked_assets.append(asset)
-    return True
-
-
-assets_request = GetAssetsRequest(
-    status=AssetStatus.ACTIVE, asset_class=AssetClass.US_EQUITY)
-assets = alpaca_trading_client.get_all_assets(filter=assets_request)
-sleep(0.3)
-symbols = [asset.symbol for asset in assets
-           if asset.tradable and asset.exchange != AssetExchange.OTC]
-# Filter out undesirable assets
-symbols = [symbol for symbol in symbols if symbol not in
-           ['VXX', 'VIXY', 'UVXY']]
-
-today = datetime.combine(
-    date=date.today(), time=datetime.min.time())
-starting_datetime = datetime(year=2015, month=12, day=1)
-
-for symbol in symbols:
-    if not import_asset(
-            symbol=symbol, start_date=starting_datetime, end_date=today):
-        # API free-rate limit: 200/min
-        sleep(0.3)
+    return prices, dates
+
+
+# Spawned compute workers import this script, which must not load again
+if __name__ == '__main__':
+    alpaca_historical_client = historical_client(
+        api_key=environ.get('APCA_API_KEY_ID'),
+        secret_key=environ.get('APCA_API_SECRET_KEY'))
+    alpaca_trading_client = trading_client(
+        api_key=environ.get('APCA_API_KEY_ID'),
+        secret_key=environ.get('APCA_API_SECRET_KEY'), paper=False)
+    mongo_client = MongoClient(environ.get('MONGO_CONNECTION_STRING'))
+    bar_cache = get_bar_cache()
+
+    today = datetime.combine(
+        date=date.today(), time=datetime.min.time())
+    starting_datetime = datetime(year=2015, month=12, day=1)
+
+    offline = bar_cache is not None and BAR_CACHE_OFFLINE
+    if offline:
+        symbols = bar_cache.symbols()
+    else:
+        assets_request = GetAssetsRequest(
+            status=AssetStatus.ACTIVE, asset_class=AssetClass.US_EQUITY)
+        assets = alpaca_trading_client.get_all_assets(filter=assets_request)
+        symbols = [asset.symbol for asset in assets
+                   if asset.tradable and asset.exchange != AssetExchange.OTC]
+    # Filter out undesirable assets
+    symbols = [symbol for symbol in symbols if symbol not in
+               ['VXX', 'VIXY', 'UVXY']]
+
+    if '--resume' in sys.argv:
+        finished = finished_symbols(mongo_client=mongo_client)
+        print('Resuming after ' + repr(len(finished))
+              + ' completed or rejected symbols')
+        symbols = [symbol for symbol in symbols if symbol not in finished]
     else:
-        print(symbol)
-
-print(len(tracked_assets))
-
-# Update MARKET_DATA collection
-market_object = {
-    'my_id': environ.get('MARKET_COLLECTION_ID'),
-    'market_is_open': True,
-    'day_of_month': today.day,
-    'latest_date': tracked_assets[0].date
-}
-mongo_db = mongo_client.get_database(name='market')
-mongo_collection = mongo_db.get_collection(name='MARKET_DATA')
-mongo_collection.insert_one(document=market_object)
-mongo_client.close()
+        clear_journal(mongo_client=mongo_client)
+    if '--rescreen' not in sys.argv:
+        known_rejections = load_rejections(
+            mongo_client=mongo_client, now=today)
+        screened = [symbol for symbol in symbols
+                    if symbol not in known_rejections]
+        print('Skipping ' + repr(len(symbols) - len(screened))
+              + ' previously rejected symbols')
+        symbols = screened
+    if not offline:
+        # Rule out most symbols before any full history download
+        calendar_request = GetCalendarRequest(
+            start=today - timedelta(days=SCREEN_CALENDAR_DAYS),
+            end=today - timedelta(days=1))
+        trading_days = [session.date for session in
+                        alpaca_trading_client.get_calendar(
+                            filters=calendar_request)]
+        rejections = prescreen(
+            client=alpaca_historical_client, symbols=symbols,
+            trading_days=trading_days)
+        # Stored now so a resumed run does not screen them again
+        record_rejections(
+            mongo_client=mongo_client, rejections=rejections, now=today)
+        symbols = [symbol for symbol in symbols if symbol not in rejections]
+        print('Pre-screen rejected ' + repr(len(rejections)) + ' symbols, '
+              + repr(len(symbols)) + ' left to download')
+
+    # Upserts and snapshots need their indexes before the first write
+    get_storage(mongo_client=mongo_client).ensure_indexes()
+    ensure_index(mongo_client=mongo_client)
+    summary = run_pipeline(
+        symbols=symbols,
+        fetch=partial(fetch_history, start_date=starting_datetime,
+                      end_date=today),
+        mongo_client=mongo_client, now=today)
+
+    print(summary.tracked)
+    # Includes rejections journaled by earlier, interrupted runs
+    record_rejections(
+        mongo_client=mongo_client,
+        rejections=journal_rejections(mongo_client=mongo_client), now=today)
+    if summary.failed:
+        print(repr(summary.failed)
+              + ' symbols failed, run again with --resume to retry them')
+    print('Alpaca calls: ' + repr(dict(CALL_COUNTS)))
+
+    # Update MARKET_DATA collection, upserted so resumed runs keep one document
+    market_object = {
+        'my_id': environ.get('MARKET_COLLECTION_ID'),
+        'market_is_open': True,
+        'day_of_month': today.day,
+        'latest_date': latest_loaded_date(mongo_client=mongo_client)
+    }
+    mongo_db = mongo_client.get_database(name='market')
+    mongo_collection = mongo_db.get_collection(name='MARKET_DATA')
+    mongo_collection.update_one(
+        filter={'my_id': market_object['my_id']},
+        update={'$set': market_object}, upsert=True)
+    mongo_client.close()
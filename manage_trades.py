@@ -1,55 +1,36 @@
 """Analyze data and manage trades"""
-from base64 import b64decode
 from bson.binary import Binary
-from datetime import date
+from datetime import date, datetime
 from math import floor
 from os import environ
-from time import sleep
-from urllib import parse
+from time import monotonic, sleep
 
-from alpaca.trading.client import TradingClient
-from alpaca.trading.enums import OrderSide, OrderType, TimeInForce
+from alpaca.trading.enums import OrderSide, OrderStatus, OrderType, TimeInForce
 from alpaca.trading.requests import MarketOrderRequest
-from boto3 import client as boto_client
-from pymongo import MongoClient
-from telegram import Bot
+import numpy as np
+
+from data.alpaca_client import CALL_ERRORS, find_order
+from data.bootstrap import Lazy, log_cold_start
+from data.connections import alpaca_trading_client, mongo_client
+from data.handler import invocation
+from data.latest_snapshot import find_latest
+from data.notifier import CRITICAL, WARNING, notifier
+from data.storage import get_storage
+from data.strategy import (
+    LONG_ENTRY, MAX_OPEN_POSITIONS, SHORT_ENTRY, TARGET_PERCENT,
+    feature_matrix)
+
+CANCEL_POLL_SECONDS = 0.25
+CANCEL_TIMEOUT_SECONDS = 10
+ENTRY_ORDER_PREFIX = 'entry-'
 
-MAX_OPEN_POSITIONS = 10
-TARGET_PERCENT = 10
-TARGET_RSI = 30
-
-LAMBDA_FUNCTION_NAME = environ.get('AWS_LAMBDA_FUNCTION_NAME')
-kms_client = boto_client('kms')
-
-
-def decrypt_kms(enc_string: str) -> str:
-    return kms_client.decrypt(
-        CiphertextBlob=b64decode(enc_string),
-        EncryptionContext={'LambdaFunctionName': LAMBDA_FUNCTION_NAME}
-    )['Plaintext'].decode('utf-8')
-
-
-ID_DECRYPTED = decrypt_kms(enc_string=environ.get('APCA_API_KEY_ID'))
-KEY_DECRYPTED = decrypt_kms(
-    enc_string=environ.get('APCA_API_SECRET_KEY'))
-BOT_DECRYPTED = decrypt_kms(enc_string=environ.get('TGM_BOT_TOKEN'))
-CHAT_DECRYPTED = decrypt_kms(enc_string=environ.get('TGM_CHAT_ID'))
-MONGO_DECRYPTED = decrypt_kms(
-    enc_string=environ.get('MONGO_CONNECTION_STRING'))
 HELD_ASSETS_ID = environ.get('HELD_ASSETS_ID')
 
-alpaca_client = TradingClient(
-    api_key=ID_DECRYPTED, secret_key=KEY_DECRYPTED, paper=False)
-telegram_bot = Bot(token=BOT_DECRYPTED)
-
-session_encoded = parse.quote_plus(environ.get('AWS_SESSION_TOKEN'))
-mongo_connection_string = MONGO_DECRYPTED + session_encoded
-mongo_client = MongoClient(mongo_connection_string)
-stock_db = mongo_client.get_database(name='stocks')
-market_db = mongo_client.get_database(name='market')
-market_collection = market_db.get_collection(name='MARKET_DATA')
-held_asset_collection = market_db.get_collection(name='HELD_ASSETS')
-market_item = market_collection.find_one()
+market_db = Lazy(factory=lambda: mongo_client.get_database(name='market'))
+market_collection = Lazy(
+    factory=lambda: market_db.get_collection(name='MARKET_DATA'))
+held_asset_collection = Lazy(
+    factory=lambda: market_db.get_collection(name='HELD_ASSETS'))
 today = date.today()
 # Do not buy stocks which just exited
 black_list = []
@@ -58,40 +39,38 @@ black_list = []
 def close_position(symbol: str) -> None:
     # Fetch open orders
     try:
-        orders = alpaca_client.get_orders()
-    except AttributeError:
+        orders = alpaca_trading_client.get_orders()
+    except (AttributeError, *CALL_ERRORS):
         message = 'Error fetching open orders!'
-        telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=message, severity=CRITICAL)
         raise ManageTradesError
-    sleep(0.3)
     message = 'Exit signal for : ' + symbol
     message += '. Canceling stop loss order then exiting position.'
-    telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
+    notifier.notify(text=message)
     current_orders = [order for order in orders
                       if order.symbol == symbol]
     if len(current_orders) != 1:
-        sleep(0.1)
         message = 'Unexpected amount of open orders for: ' + symbol
         message += '. INVESTIGATE IMMEDIATELY.'
-        telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=message, severity=CRITICAL)
         raise ManageTradesError
     stop_loss_order = current_orders[0]
     try:
-        alpaca_client.cancel_order_by_id(
+        alpaca_trading_client.cancel_order_by_id(
             order_id=stop_loss_order.id)
-    except AttributeError as aerr:
+    except (AttributeError, *CALL_ERRORS) as aerr:
         message = 'Error canceling stop loss order for: ' + symbol
         message += '. Exception: ' + repr(aerr)
-        telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=message, severity=CRITICAL)
         raise ManageTradesError
     # Wait for above order to fully cancel
-    sleep(2)
+    wait_for_cancel(order_id=stop_loss_order.id, symbol=symbol)
     try:
-        alpaca_client.close_position(symbol_or_asset_id=symbol)
-    except AttributeError as aerr:
+        alpaca_trading_client.close_position(symbol_or_asset_id=symbol)
+    except (AttributeError, *CALL_ERRORS) as aerr:
         message = 'Error submitting exit order for: ' + symbol
         message += '. Exception: ' + repr(aerr)
-        telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=message, severity=CRITICAL)
         raise ManageTradesError
 
 
@@ -103,12 +82,11 @@ def execute_entry_orders(
 
     message = 'Buy signal: ' + repr(signals.keys())
     try:
-        account = alpaca_client.get_account()
-    except AttributeError:
+        account = alpaca_trading_client.get_account()
+    except (AttributeError, *CALL_ERRORS):
         message = 'Error fetching trading account!'
-        telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=message, severity=CRITICAL)
         raise ManageTradesError
-    sleep(0.3)
     cash_on_hand = float(account.buying_power)
     txn_amount = cash_on_hand / (MAX_OPEN_POSITIONS - num_positions)
     message += '. ' + str(txn_amount)
@@ -120,35 +98,44 @@ def execute_entry_orders(
             message += '. But stock price too high for: ' + symbol
         else:
             txn_quantity = floor(txn_amount / closing_price)
+            # One entry per symbol and day, so Alpaca refuses a repeat
+            client_order_id = (
+                ENTRY_ORDER_PREFIX + symbol + '-' + today.isoformat())
             if is_long:
                 order_request = MarketOrderRequest(
                     symbol=symbol, qty=txn_quantity, side=OrderSide.BUY,
-                    type=OrderType.MARKET, time_in_force=TimeInForce.DAY)
+                    type=OrderType.MARKET, time_in_force=TimeInForce.DAY,
+                    client_order_id=client_order_id)
             else:
                 try:
-                    asset = alpaca_client.get_asset(symbol_or_asset_id=symbol)
-                except AttributeError as aerr:
+                    asset = alpaca_trading_client.get_asset(
+                        symbol_or_asset_id=symbol)
+                except (AttributeError, *CALL_ERRORS) as aerr:
                     err = 'Error checking shortable for: ' + symbol
                     err += '. Exception: ' + repr(aerr)
-                    telegram_bot.send_message(text=err, chat_id=CHAT_DECRYPTED)
+                    notifier.notify(text=err, severity=CRITICAL)
                     raise ManageTradesError
-                sleep(0.3)
                 if asset.shortable and asset.easy_to_borrow:
                     order_request = MarketOrderRequest(
                         symbol=symbol, qty=txn_quantity, side=OrderSide.SELL,
-                        type=OrderType.MARKET, time_in_force=TimeInForce.DAY)
+                        type=OrderType.MARKET, time_in_force=TimeInForce.DAY,
+                        client_order_id=client_order_id)
                 else:
                     message += '. Not shortable: ' + symbol
                     continue
             try:
-                order = alpaca_client.submit_order(
+                order = alpaca_trading_client.submit_order(
                     order_data=order_request)
-            except AttributeError as aerr:
-                err = 'Error submitting order for: ' + symbol
-                err += '. Exception: ' + repr(aerr)
-                telegram_bot.send_message(text=err, chat_id=CHAT_DECRYPTED)
-                raise ManageTradesError
-            sleep(0.3)
+            except (AttributeError, *CALL_ERRORS) as aerr:
+                # After a lost response the retry is refused as a duplicate
+                # while the first attempt stands
+                order = find_order(client=alpaca_trading_client,
+                                   client_order_id=client_order_id)
+                if order is None:
+                    err = 'Error submitting order for: ' + symbol
+                    err += '. Exception: ' + repr(aerr)
+                    notifier.notify(text=err, severity=CRITICAL)
+                    raise ManageTradesError
             asset_object = {
                 symbol: {
                     'order_id': Binary.from_uuid(uuid=order.id),
@@ -160,45 +147,52 @@ def execute_entry_orders(
                 update={'$set': asset_object})
             num_positions += 1
     message += '. Orders successfully placed.'
-    telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
+    notifier.notify(text=message)
     return num_positions
 
 
-def is_market_open() -> bool:
+def is_market_open(market_item: dict) -> bool:
     """Check if market is open today"""
     if market_item['day_of_month'] != today.day:
         error_message = 'Dates do not match up! '
         error_message += 'DB day: ' + repr(market_item['day_of_month'])
         error_message += '. Yesterday day: ' + repr(today.day)
-        telegram_bot.send_message(text=error_message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=error_message, severity=CRITICAL)
         raise ManageTradesError
 
     return market_item['market_is_open']
 
 
 def lambda_handler(event, context):
-    try:
-        if is_market_open():
-            manage_trades()
-    except ManageTradesError:
-        return
-    except Exception as err:
-        error_message = 'Unexpected exception: ' + repr(err)
-        telegram_bot.send_message(text=error_message, chat_id=CHAT_DECRYPTED)
-    finally:
-        mongo_client.close()
-
-
-def manage_trades() -> None:
+    global today
+    today = date.today()
+    black_list.clear()
+    with invocation():
+        try:
+            market_item = market_collection.find_one()
+            if is_market_open(market_item=market_item):
+                manage_trades(latest_date=market_item['latest_date'])
+        except ManageTradesError:
+            return
+        except Exception as err:
+            error_message = 'Unexpected exception: ' + repr(err)
+            notifier.notify(text=error_message, severity=CRITICAL)
+
+
+def manage_trades(latest_date: datetime) -> None:
     # Fetch open positions
     try:
-        positions = alpaca_client.get_all_positions()
-    except AttributeError:
+        positions = alpaca_trading_client.get_all_positions()
+    except (AttributeError, *CALL_ERRORS):
         error_message = 'Error fetching open positions!'
-        telegram_bot.send_message(text=error_message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=error_message, severity=CRITICAL)
         raise ManageTradesError
-    sleep(0.3)
-    latest_date = market_item['latest_date']
+    # One query covers open positions and both signal scans
+    snapshots = find_latest(mongo_client=mongo_client, latest_date=latest_date)
+    if not snapshots:
+        # LATEST is only seeded by update_data and initial_dataload
+        snapshots = {document['symbol']: document for document in get_storage(
+            mongo_client=mongo_client).find_all_on_date(date=latest_date)}
     held_assets = held_asset_collection.find_one()
     # Remove ID-related keys
     del held_assets['_id']
@@ -211,7 +205,7 @@ def manage_trades() -> None:
     if exited_symbols:
         message = 'WARNING Stop loss detected for: ' + repr(exited_symbols)
         message += '. Removing from tracked positions.'
-        telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=message, severity=WARNING)
         for exited_symbol in exited_symbols:
             del held_assets[exited_symbol]
             held_asset_collection.update_one(
@@ -222,8 +216,12 @@ def manage_trades() -> None:
     # Second check open positions for target and/or exit signal
     for position in positions:
         symbol = position.symbol
-        stock_collection = stock_db.get_collection(name=symbol)
-        stock_item = stock_collection.find_one(filter={'date': latest_date})
+        stock_item = snapshots.get(symbol)
+        if stock_item is None:
+            message = 'No latest data for held position: ' + symbol
+            message += '. Unable to manage it, INVESTIGATE.'
+            notifier.notify(text=message, severity=CRITICAL)
+            continue
         is_long = held_assets[symbol]['is_long']
         macd_bigger = stock_item['macd'] > stock_item['macd_signal']
         # If target not already hit, check for target hit
@@ -233,7 +231,7 @@ def manage_trades() -> None:
             if entry_price_str is None or entry_price_str == '':
                 message = 'Empty value for avg_entry_price! '
                 message += 'Unable to determine target for: ' + symbol
-                telegram_bot.send_message(text=message, chat_id=CHAT_DECRYPTED)
+                notifier.notify(text=message, severity=CRITICAL)
                 raise ManageTradesError
             entry_price = float(entry_price_str)
             # Long
@@ -243,8 +241,7 @@ def manage_trades() -> None:
                     message = 'Target reached for long: ' + symbol
                     message += '. entry_price: ' + repr(entry_price)
                     message += '. latest_close: ' + repr(latest_close)
-                    telegram_bot.send_message(
-                        text=message, chat_id=CHAT_DECRYPTED)
+                    notifier.notify(text=message)
                     held_asset_collection.update_one(
                         filter={'my_id': HELD_ASSETS_ID},
                         update={'$set': {symbol: {'target_met': True,
@@ -257,8 +254,7 @@ def manage_trades() -> None:
                     message = 'Target reached for short: ' + symbol
                     message += '. entry_price: ' + repr(entry_price)
                     message += '. latest_close: ' + repr(latest_close)
-                    telegram_bot.send_message(
-                        text=message, chat_id=CHAT_DECRYPTED)
+                    notifier.notify(text=message)
                     held_asset_collection.update_one(
                         filter={'my_id': HELD_ASSETS_ID},
                         update={'$set': {symbol: {'target_met': True,
@@ -275,67 +271,56 @@ def manage_trades() -> None:
                     update={'$unset': {symbol: ''}})
                 black_list.append(symbol)
 
-    # Determine long signals and place buy orders
+    # Screen every candidate with one array operation per rule
+    candidates = [asset for symbol, asset in snapshots.items()
+                  if symbol not in black_list
+                  and symbol not in position_symbols]
+    features = feature_matrix(documents=candidates)
+    long_signals = {
+        candidates[row]['symbol']: candidates[row]['close']
+        for row in np.flatnonzero(LONG_ENTRY.mask(matrix=features))}
+    short_signals = {
+        candidates[row]['symbol']: candidates[row]['close']
+        for row in np.flatnonzero(SHORT_ENTRY.mask(matrix=features))}
+
+    # Place buy orders
     position_tracker = len(held_assets)
-    if len(held_assets) < MAX_OPEN_POSITIONS:
-        long_signals = {}
-        for symbol in stock_db.list_collection_names():
-            if symbol in black_list or symbol in position_symbols:
-                continue
-            asset_collection = stock_db.get_collection(symbol)
-            asset = asset_collection.find_one(filter={'date': latest_date})
-
-            if should_buy_long(asset=asset):
-                long_signals[symbol] = asset['close']
-        if long_signals:
-            position_tracker = execute_entry_orders(
-                signals=long_signals,
-                num_positions=position_tracker,
-                is_long=True)
-
-    # Determine short signals and place sell orders
-    if position_tracker < MAX_OPEN_POSITIONS:
-        short_signals = {}
-        for symbol in stock_db.list_collection_names():
-            if symbol in black_list or symbol in position_symbols:
-                continue
-            asset_collection = stock_db.get_collection(symbol)
-            asset = asset_collection.find_one(filter={'date': latest_date})
-
-            if should_sell_short(asset=asset):
-                short_signals[symbol] = asset['close']
-        if short_signals:
-            execute_entry_orders(
-                signals=short_signals,
-                num_positions=position_tracker,
-                is_long=False)
-
-
-def should_buy_long(asset: dict) -> bool:
-    if asset['macd'] > asset['macd_signal']:
-        filtered_rsi = [rsi_value for rsi_value in asset['rsi']
-                        if rsi_value < TARGET_RSI]
-        if filtered_rsi:
-            filtered_trend = [
-                trend_value for trend_value in asset['trend']
-                if trend_value]
-            if filtered_trend:
-                return True
-    return False
-
-
-def should_sell_short(asset: dict) -> bool:
-    if asset['macd'] < asset['macd_signal']:
-        filtered_rsi = [rsi_value for rsi_value in asset['rsi']
-                        if rsi_value > (100 - TARGET_RSI)]
-        if filtered_rsi:
-            filtered_trend = [
-                trend_value for trend_value in asset['trend']
-                if not trend_value]
-            if filtered_trend:
-                return True
-    return False
+    if len(held_assets) < MAX_OPEN_POSITIONS and long_signals:
+        position_tracker = execute_entry_orders(
+            signals=long_signals,
+            num_positions=position_tracker,
+            is_long=True)
+
+    # Place sell orders
+    if position_tracker < MAX_OPEN_POSITIONS and short_signals:
+        execute_entry_orders(
+            signals=short_signals,
+            num_positions=position_tracker,
+            is_long=False)
+
+
+def wait_for_cancel(order_id, symbol: str) -> None:
+    """Poll the canceled order instead of sleeping a fixed amount"""
+    deadline = monotonic() + CANCEL_TIMEOUT_SECONDS
+    while monotonic() < deadline:
+        try:
+            order = alpaca_trading_client.get_order_by_id(order_id=order_id)
+        except (AttributeError, *CALL_ERRORS) as aerr:
+            message = 'Error checking canceled order for: ' + symbol
+            message += '. Exception: ' + repr(aerr)
+            notifier.notify(text=message, severity=CRITICAL)
+            raise ManageTradesError
+        if order.status == OrderStatus.CANCELED:
+            return
+        sleep(CANCEL_POLL_SECONDS)
+    message = 'Stop loss order did not cancel in time for: ' + symbol
+    message += '. INVESTIGATE IMMEDIATELY.'
+    notifier.notify(text=message, severity=CRITICAL)
+    raise ManageTradesError
 
 
 class ManageTradesError(Exception):
     pass
+
+
+log_cold_start()
@@ -1,75 +1,90 @@
 """For all new positions entered today, submit stop loss orders"""
-from base64 import b64decode
 from bson.binary import Binary
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from os import environ
-from time import sleep
-from urllib import parse
-
-from alpaca.trading.client import TradingClient
-from alpaca.trading.enums import OrderSide, OrderStatus, OrderType, TimeInForce
-from alpaca.trading.requests import StopOrderRequest
-from boto3 import client as boto_client
-from pymongo import MongoClient
-from telegram import Bot
-
-STOP_LOSS_PERCENT = 10
-
-LAMBDA_FUNCTION_NAME = environ.get('AWS_LAMBDA_FUNCTION_NAME')
-kms_client = boto_client('kms')
-
-
-def decrypt_kms(enc_string: str) -> str:
-    return kms_client.decrypt(
-        CiphertextBlob=b64decode(enc_string),
-        EncryptionContext={'LambdaFunctionName': LAMBDA_FUNCTION_NAME}
-    )['Plaintext'].decode('utf-8')
-
-
-ID_DECRYPTED = decrypt_kms(enc_string=environ.get('APCA_API_KEY_ID'))
-KEY_DECRYPTED = decrypt_kms(
-    enc_string=environ.get('APCA_API_SECRET_KEY'))
-BOT_DECRYPTED = decrypt_kms(enc_string=environ.get('TGM_BOT_TOKEN'))
-CHAT_DECRYPTED = decrypt_kms(enc_string=environ.get('TGM_CHAT_ID'))
-MONGO_DECRYPTED = decrypt_kms(
-    enc_string=environ.get('MONGO_CONNECTION_STRING'))
-
-alpaca_client = TradingClient(
-    api_key=ID_DECRYPTED, secret_key=KEY_DECRYPTED, paper=False)
-telegram_bot = Bot(token=BOT_DECRYPTED)
-
-session_encoded = parse.quote_plus(environ.get('AWS_SESSION_TOKEN'))
-mongo_connection_string = MONGO_DECRYPTED + session_encoded
-mongo_client = MongoClient(mongo_connection_string)
-market_db = mongo_client.get_database(name='market')
-market_collection = market_db.get_collection(name='MARKET_DATA')
-market_item = market_collection.find_one()
+from typing import Any
+
+from alpaca.trading.enums import (
+    OrderSide, OrderStatus, OrderType, QueryOrderStatus, TimeInForce)
+from alpaca.trading.requests import GetOrdersRequest, StopOrderRequest
+
+from data.alpaca_client import CALL_ERRORS, find_order
+from data.bootstrap import Lazy, log_cold_start
+from data.connections import alpaca_trading_client, mongo_client
+from data.handler import invocation
+from data.notifier import CRITICAL, notifier
+from data.strategy import STOP_LOSS_PERCENT
+
+# Largest page Alpaca returns from one orders request
+MAX_ORDERS = 500
+STOP_ORDER_PREFIX = 'stop-'
+SUBMIT_WORKERS = 8
+
+market_db = Lazy(factory=lambda: mongo_client.get_database(name='market'))
+market_collection = Lazy(
+    factory=lambda: market_db.get_collection(name='MARKET_DATA'))
 today = date.today()
 
 
-def is_market_open() -> bool:
+def is_market_open(market_item: dict) -> bool:
     """Check if market is open today"""
     if market_item['day_of_month'] != today.day:
         error_message = 'Dates do not match up! '
         error_message += 'DB day: ' + repr(market_item['day_of_month'])
         error_message += '. Yesterday day: ' + repr(today.day)
-        telegram_bot.send_message(text=error_message, chat_id=CHAT_DECRYPTED)
+        notifier.notify(text=error_message, severity=CRITICAL)
         raise ProcessNewOrdersError
 
     return market_item['market_is_open']
 
 
 def lambda_handler(event, context):
+    global today
+    today = date.today()
+    with invocation():
+        try:
+            market_item = market_collection.find_one()
+            if is_market_open(market_item=market_item):
+                process_new_orders()
+        except ProcessNewOrdersError:
+            return
+        except Exception as err:
+            error_message = 'Unexpected exception: ' + repr(err)
+            notifier.notify(text=error_message, severity=CRITICAL)
+
+
+def place_stop_loss(symbol: str, order: Any, is_long: bool) -> None:
+    """Submit the stop loss for a filled order"""
+    filled_quantity = int(order.filled_qty)
+    filled_price = float(order.filled_avg_price)
+    if is_long:
+        stop_loss_price = round(
+            number=(filled_price * ((100 - STOP_LOSS_PERCENT) / 100)),
+            ndigits=2)
+        stop_loss_side = OrderSide.SELL
+    else:
+        stop_loss_price = round(
+            number=(filled_price * ((100 + STOP_LOSS_PERCENT) / 100)),
+            ndigits=2)
+        stop_loss_side = OrderSide.BUY
+
+    # Derived from the fill, so Alpaca refuses a second copy on retry
+    client_order_id = STOP_ORDER_PREFIX + str(order.id)
+    order_request = StopOrderRequest(
+        symbol=symbol, qty=filled_quantity,
+        side=stop_loss_side, type=OrderType.MARKET,
+        time_in_force=TimeInForce.GTC,
+        stop_price=stop_loss_price, client_order_id=client_order_id)
+    # The client already retries transient errors with backoff
     try:
-        if is_market_open():
-            process_new_orders()
-    except ProcessNewOrdersError:
-        return
-    except Exception as err:
-        error_message = 'Unexpected exception: ' + repr(err)
-        telegram_bot.send_message(text=error_message, chat_id=CHAT_DECRYPTED)
-    finally:
-        mongo_client.close()
+        alpaca_trading_client.submit_order(order_data=order_request)
+    except CALL_ERRORS:
+        # An attempt accepted before its response was lost makes the
+        # client's retry fail as a duplicate client order id
+        if find_order(client=alpaca_trading_client,
+                      client_order_id=client_order_id) is None:
+            raise
 
 
 def process_new_orders() -> None:
@@ -79,65 +94,61 @@ def process_new_orders() -> None:
     del held_assets['_id']
     del held_assets['my_id']
 
-    for symbol in held_assets:
-        if 'order_id' in held_assets[symbol]:
-            try:
-                order = alpaca_client.get_order_by_id(
-                    order_id=Binary.as_uuid(held_assets[symbol]['order_id']))
-            except AttributeError as aerr:
-                message = 'Error getting order for: ' + symbol
-                message += '. Exception: ' + repr(aerr)
-                telegram_bot.send_message(
-                    text=message, chat_id=CHAT_DECRYPTED)
-                raise ProcessNewOrdersError
-            sleep(0.3)
+    order_ids = {symbol: Binary.as_uuid(held_assets[symbol]['order_id'])
+                 for symbol in held_assets
+                 if 'order_id' in held_assets[symbol]}
+    if not order_ids:
+        return
+    # Filled orders are closed, so one request covers every new position
+    orders_request = GetOrdersRequest(
+        status=QueryOrderStatus.CLOSED, symbols=list(order_ids),
+        limit=MAX_ORDERS)
+    orders = {order.id: order for order in
+              alpaca_trading_client.get_orders(filter=orders_request)}
+
+    def process_symbol(symbol: str) -> bool:
+        """Place the stop loss, or report why not and return False"""
+        try:
+            order = orders.get(order_ids[symbol])
+            if order is None:
+                # Still open, or older than the batch returned
+                order = alpaca_trading_client.get_order_by_id(
+                    order_id=order_ids[symbol])
             if order.status != OrderStatus.FILLED:
                 message = 'Unexpected order status for: ' + symbol
                 message += '. Status: ' + repr(order.status)
-                telegram_bot.send_message(
-                    text=message, chat_id=CHAT_DECRYPTED)
-                raise ProcessNewOrdersError
-
-            filled_quantity = int(order.filled_qty)
-            filled_price = float(order.filled_avg_price)
-            is_long = held_assets[symbol]['is_long']
-            if is_long:
-                stop_loss_price = round(
-                    number=(filled_price * ((100 - STOP_LOSS_PERCENT) / 100)),
-                    ndigits=2)
-                stop_loss_side = OrderSide.SELL
-            else:
-                stop_loss_price = round(
-                    number=(filled_price * ((100 + STOP_LOSS_PERCENT) / 100)),
-                    ndigits=2)
-                stop_loss_side = OrderSide.BUY
-
-            order_request = StopOrderRequest(
-                symbol=symbol, qty=filled_quantity,
-                side=stop_loss_side, type=OrderType.MARKET,
-                time_in_force=TimeInForce.GTC,
-                stop_price=stop_loss_price)
-            try:
-                alpaca_client.submit_order(
-                    order_data=order_request)
-            except AttributeError as aerr:
-                err = 'Error submitting stop loss order for: ' + symbol
-                err += '. Exception: ' + repr(aerr)
-                telegram_bot.send_message(
-                    text=err, chat_id=CHAT_DECRYPTED)
-                raise ProcessNewOrdersError
-            message = 'Found new order, placed stop loss: ' + symbol
-            telegram_bot.send_message(
-                text=message, chat_id=CHAT_DECRYPTED)
-
-            update_object = {
+                notifier.notify(text=message, severity=CRITICAL)
+                return False
+            place_stop_loss(symbol=symbol, order=order,
+                            is_long=held_assets[symbol]['is_long'])
+        except Exception as err:
+            message = 'Error placing stop loss for: ' + symbol
+            message += '. Exception: ' + repr(err)
+            notifier.notify(text=message, severity=CRITICAL)
+            return False
+        return True
+
+    # Requests still pass through the shared rate limiter
+    with ThreadPoolExecutor(max_workers=SUBMIT_WORKERS) as executor:
+        placed = [symbol for symbol, success in zip(
+            order_ids, executor.map(process_symbol, order_ids)) if success]
+    if not placed:
+        return
+
+    # Failed symbols keep their order_id, so the next run retries them
+    held_asset_collection.update_one(
+        filter={'my_id': environ.get('HELD_ASSETS_ID')},
+        update={'$set': {
+            symbol: {
                 'target_met': False,
-                'is_long': is_long
-            }
-            held_asset_collection.update_one(
-                filter={'my_id': environ.get('HELD_ASSETS_ID')},
-                update={'$set': {symbol: update_object}})
+                'is_long': held_assets[symbol]['is_long']
+            } for symbol in placed}})
+    message = 'Found new orders, placed stop losses: ' + ', '.join(placed)
+    notifier.notify(text=message)
 
 
 class ProcessNewOrdersError(Exception):
     pass
+
+
+log_cold_start()
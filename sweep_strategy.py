@@ -0,0 +1,81 @@
+"""Backtest a grid or random sample of strategy thresholds in parallel
+
+Usage: python sweep_strategy.py [--cache] [--samples N] [--workers N]
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from os import environ
+from random import Random
+from tempfile import TemporaryDirectory
+
+from pymongo import MongoClient
+
+from data.backtest import (
+    load_from_cache, load_from_storage, load_market, run_backtest,
+    save_market)
+from data.bar_cache import get_bar_cache
+from data.storage import get_storage
+
+PARAMETER_GRID = {
+    'target_rsi': [20, 25, 30, 35],
+    'target_percent': [5, 10, 15, 20],
+    'stop_loss_percent': [5, 10, 15],
+    'max_open_positions': [5, 10, 20]
+}
+
+# Set in every worker by load_shared_market
+shared_market = None
+
+
+def load_shared_market(directory: str) -> None:
+    global shared_market
+    shared_market = load_market(directory=directory)
+
+
+def run_parameters(parameters: dict) -> dict:
+    result = run_backtest(market=shared_market, **parameters)
+    return {**parameters, 'roi': result.roi,
+            'max_drawdown': result.max_drawdown,
+            'trades': result.trade_count}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--cache', action='store_true',
+                        help='recompute indicators from the local bar cache')
+    parser.add_argument('--samples', type=int,
+                        help='random sample size instead of the full grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args()
+
+    if args.cache:
+        market = load_from_cache(cache=get_bar_cache())
+    else:
+        mongo_client = MongoClient(environ.get('MONGO_CONNECTION_STRING'))
+        market = load_from_storage(
+            storage=get_storage(mongo_client=mongo_client))
+        mongo_client.close()
+
+    grid = [dict(zip(PARAMETER_GRID, values))
+            for values in product(*PARAMETER_GRID.values())]
+    if args.samples is not None and args.samples < len(grid):
+        grid = Random(args.seed).sample(grid, args.samples)
+
+    with TemporaryDirectory() as market_directory:
+        # Workers map the same files instead of receiving pickled copies
+        save_market(market=market, directory=market_directory)
+        with ProcessPoolExecutor(
+                max_workers=args.workers, initializer=load_shared_market,
+                initargs=(market_directory,)) as executor:
+            results = list(executor.map(run_parameters, grid))
+
+    results.sort(key=lambda row: row['roi'], reverse=True)
+    columns = [*PARAMETER_GRID, 'roi', 'max_drawdown', 'trades']
+    print(' '.join(column.rjust(18) for column in columns))
+    for row in results:
+        print(' '.join(
+            ('{:.2f}'.format(row[column]) if isinstance(row[column], float)
+             else str(row[column])).rjust(18)
+            for column in columns))
@@ -0,0 +1,324 @@
+"""Indicator paths against scalar reference loops
+
+The reference loops are plain transcriptions of the original per-day
+calculations, seeds included, and share no code with data/indicators.py.
+Every scenario is checked over the full history, from the first price.
+"""
+from datetime import datetime, timedelta
+from math import inf, isnan, nan
+from random import Random
+
+import numpy as np
+import pytest
+
+from benchmark_indicators import StubClient
+from data.indicators import (
+    EMA_BIG_LONG_PERIOD, MACD_LONG_PERIOD, MACD_SHORT_PERIOD,
+    MACD_SIGNAL_PERIOD, RSI_PERIOD, RSI_QUEUE, SMOOTH_9, SMOOTH_12,
+    SMOOTH_26, SMOOTH_200, TREND_QUEUE, IndicatorSeries, compute_indicators)
+from data.tracked_asset import INITIAL_DATA_POINTS, TrackedAsset
+
+SYMBOLS = 20
+DAYS = 600
+# Relative error allowed, floored at the scale of the field
+TOLERANCE = 1e-9
+FIRST_DATE = datetime(2015, 1, 1)
+
+
+def flat_runs(random: Random, days: int) -> list[float]:
+    """Flat start, so average losses (and at first gains) stay exactly zero"""
+    flat_days = random.randint(INITIAL_DATA_POINTS + 10,
+                               INITIAL_DATA_POINTS + 40)
+    prices = [50.0] * flat_days
+    while len(prices) < days:
+        if random.random() < 0.05:
+            prices.extend([prices[-1]] * random.randint(5, 30))
+        else:
+            prices.append(prices[-1] * (1 + random.gauss(0.002, 0.02)))
+    return prices[:days]
+
+
+def gaps(random: Random, days: int) -> list[float]:
+    """Random walk with occasional large overnight gaps"""
+    prices = [random.uniform(5, 500)]
+    for _ in range(days - 1):
+        move = random.gauss(0, 0.02)
+        if random.random() < 0.02:
+            move += random.choice((-1, 1)) * random.uniform(0.1, 0.4)
+        prices.append(max(0.01, prices[-1] * (1 + move)))
+    return prices
+
+
+def random_walk(random: Random, days: int) -> list[float]:
+    prices = [random.uniform(5, 500)]
+    for _ in range(days - 1):
+        prices.append(max(0.01, prices[-1] * (1 + random.gauss(0, 0.02))))
+    return prices
+
+
+def splits(random: Random, days: int) -> list[float]:
+    """Random walk with unadjusted split-like jumps"""
+    prices = random_walk(random=random, days=days)
+    for _ in range(random.randint(1, 3)):
+        ratio = random.choice((0.5, 1 / 3, 0.1, 2.0, 10.0))
+        split_day = random.randrange(1, days)
+        prices[split_day:] = [price * ratio for price in prices[split_day:]]
+    return prices
+
+
+SCENARIOS = {
+    'random_walk': random_walk,
+    'gaps': gaps,
+    'flat_runs': flat_runs,
+    'splits': splits
+}
+DATES = [FIRST_DATE + timedelta(days=day) for day in range(DAYS)]
+
+
+def cases(scenario: str) -> list[tuple[str, list[float]]]:
+    """Symbols and prices of a scenario, the same on every run"""
+    random = Random(scenario)
+    return [(scenario.upper() + repr(number),
+             SCENARIOS[scenario](random=random, days=DAYS))
+            for number in range(SYMBOLS)]
+
+
+def compare_documents(expected: dict, actual: dict,
+                      errors: dict[str, float]) -> None:
+    """Record the largest scaled error of every field into errors"""
+    for field, value in expected.items():
+        other = actual[field]
+        if field in ('symbol', 'date', 'trend'):
+            errors[field] = max(errors.get(field, 0.0),
+                                0.0 if value == other else inf)
+            continue
+        if field == 'rsi':
+            pairs = zip(value, other)
+            scale = 100.0
+        else:
+            pairs = [(value, other)]
+            scale = abs(expected['close'])
+        for left, right in pairs:
+            errors[field] = max(errors.get(field, 0.0), scaled_error(
+                left=left, right=right, scale=scale))
+
+
+def compare_series(expected: dict[str, list[float]], actual: IndicatorSeries,
+                   prices: list[float], errors: dict[str, float]) -> None:
+    """Record the largest scaled error of every series over every day"""
+    for field, values in expected.items():
+        others = getattr(actual, field).tolist()
+        if field == 'above_trend':
+            errors[field] = max(errors.get(field, 0.0),
+                                0.0 if values == others else inf)
+            continue
+        for price, left, right in zip(prices, values, others):
+            errors[field] = max(errors.get(field, 0.0), scaled_error(
+                left=left, right=right,
+                scale=100.0 if field == 'rsi' else abs(price)))
+
+
+def reference_documents(symbol: str, prices: list[float],
+                        dates: list[datetime]) -> list[dict]:
+    """Stored documents as the original day-by-day loops produced them"""
+    series = reference_series(prices=prices)
+    return [{'symbol': symbol,
+             'date': dates[day],
+             'close': prices[day],
+             'ema_short': series['ema_short'][day],
+             'ema_long': series['ema_long'][day],
+             'macd': series['macd'][day],
+             'macd_signal': series['macd_signal'][day],
+             'average_gains': series['average_gains'][day],
+             'average_losses': series['average_losses'][day],
+             'rsi': series['rsi'][day - RSI_QUEUE + 1:day + 1],
+             'ema_big_long': series['ema_big_long'][day],
+             'trend': series['above_trend'][day - TREND_QUEUE + 1:day + 1]}
+            for day in range(INITIAL_DATA_POINTS, len(prices))]
+
+
+def reference_ema(prices: list[float], period: int,
+                  smoothing: float) -> list[float]:
+    """EMA seeded with the simple average of the first period prices"""
+    ema = [nan] * len(prices)
+    if len(prices) < period:
+        return ema
+    value = sum(prices[:period]) / period
+    ema[period - 1] = value
+    for day in range(period, len(prices)):
+        value = (prices[day] - value) * smoothing + value
+        ema[day] = value
+    return ema
+
+
+def reference_macd(prices: list[float]) -> tuple[list[float], ...]:
+    """Short EMA, long EMA, MACD and a signal seeded with an average MACD"""
+    ema_short = reference_ema(
+        prices=prices, period=MACD_SHORT_PERIOD, smoothing=SMOOTH_12)
+    ema_long = reference_ema(
+        prices=prices, period=MACD_LONG_PERIOD, smoothing=SMOOTH_26)
+    macd = [short - long for short, long in zip(ema_short, ema_long)]
+    macd_signal = [nan] * len(prices)
+    # The seed averages the MACD of days 26 to 34 and lands on day 34
+    signal_start = MACD_LONG_PERIOD + MACD_SIGNAL_PERIOD
+    if len(prices) >= signal_start:
+        value = sum(macd[MACD_LONG_PERIOD:signal_start]) / MACD_SIGNAL_PERIOD
+        macd_signal[signal_start - 1] = value
+        for day in range(signal_start, len(prices)):
+            value = (macd[day] - value) * SMOOTH_9 + value
+            macd_signal[day] = value
+    return ema_short, ema_long, macd, macd_signal
+
+
+def reference_rsi(prices: list[float]) -> tuple[list[float], ...]:
+    """Wilder averages seeded with the mean of the first RSI_PERIOD moves"""
+    average_gains = [nan] * len(prices)
+    average_losses = [nan] * len(prices)
+    rsi = [nan] * len(prices)
+    if len(prices) <= RSI_PERIOD:
+        return average_gains, average_losses, rsi
+    gains = 0.0
+    losses = 0.0
+    for day in range(1, len(prices)):
+        change = prices[day] - prices[day - 1]
+        if day <= RSI_PERIOD:
+            if change >= 0:
+                gains += change / RSI_PERIOD
+            else:
+                losses -= change / RSI_PERIOD
+            if day < RSI_PERIOD:
+                continue
+        elif change >= 0:
+            gains = ((RSI_PERIOD - 1) * gains + change) / RSI_PERIOD
+            losses = (RSI_PERIOD - 1) * losses / RSI_PERIOD
+        else:
+            gains = (RSI_PERIOD - 1) * gains / RSI_PERIOD
+            losses = ((RSI_PERIOD - 1) * losses - change) / RSI_PERIOD
+        average_gains[day] = gains
+        average_losses[day] = losses
+        if losses:
+            rsi[day] = 100 - 100 / (1 + gains / losses)
+        else:
+            # No losses at all is 100, no moves at all is undefined
+            rsi[day] = 100.0 if gains else nan
+    return average_gains, average_losses, rsi
+
+
+def reference_series(prices: list[float]) -> dict[str, list[float]]:
+    """Every indicator for every day, keyed like IndicatorSeries"""
+    ema_short, ema_long, macd, macd_signal = reference_macd(prices=prices)
+    average_gains, average_losses, rsi = reference_rsi(prices=prices)
+    ema_big_long = reference_ema(
+        prices=prices, period=EMA_BIG_LONG_PERIOD, smoothing=SMOOTH_200)
+    return {'ema_short': ema_short,
+            'ema_long': ema_long,
+            'macd': macd,
+            'macd_signal': macd_signal,
+            'average_gains': average_gains,
+            'average_losses': average_losses,
+            'rsi': rsi,
+            'ema_big_long': ema_big_long,
+            # Comparing with NaN is False before the trend line exists
+            'above_trend': [price > ema
+                            for price, ema in zip(prices, ema_big_long)]}
+
+
+def scaled_error(left: float, right: float, scale: float) -> float:
+    if isnan(left) or isnan(right):
+        return 0.0 if isnan(left) and isnan(right) else inf
+    return abs(left - right) / max(abs(left), abs(right), scale, 1e-12)
+
+
+def worst_fields(errors: dict[str, float]) -> dict[str, float]:
+    """Fields whose largest error is over the tolerance"""
+    return {field: error for field, error in errors.items()
+            if error > TOLERANCE}
+
+
+@pytest.mark.parametrize('scenario', SCENARIOS)
+def test_build_history_matches_reference(scenario: str):
+    errors = {}
+    for symbol, prices in cases(scenario=scenario):
+        reference = reference_documents(
+            symbol=symbol, prices=prices, dates=DATES)
+        history = TrackedAsset(
+            symbol=symbol, date=DATES[-1], close=prices[-1]
+        ).build_history(prices=prices, dates=DATES)
+        assert len(history) == len(reference)
+        for expected, document in zip(reference, history):
+            compare_documents(
+                expected=expected, actual=document, errors=errors)
+    assert not worst_fields(errors=errors)
+
+
+@pytest.mark.parametrize('scenario', SCENARIOS)
+def test_calculate_passes_match_reference(scenario: str):
+    errors = {}
+    for symbol, prices in cases(scenario=scenario):
+        mongo_client = StubClient()
+        asset = TrackedAsset(symbol=symbol, date=DATES[-1], close=prices[-1])
+        asset.calculate_macd(
+            prices=prices, dates=DATES, mongo_client=mongo_client)
+        asset.calculate_rsi(
+            prices=prices, dates=DATES, mongo_client=mongo_client)
+        asset.calculate_ema_big_long(
+            prices=prices, dates=DATES, mongo_client=mongo_client)
+        stored = mongo_client.documents()
+        for expected in reference_documents(
+                symbol=symbol, prices=prices, dates=DATES):
+            compare_documents(
+                expected=expected, actual=stored[(symbol, expected['date'])],
+                errors=errors)
+    assert not worst_fields(errors=errors)
+
+
+@pytest.mark.parametrize('scenario', SCENARIOS)
+def test_indicators_match_reference_every_day(scenario: str):
+    errors = {}
+    for _, prices in cases(scenario=scenario):
+        compare_series(
+            expected=reference_series(prices=prices),
+            actual=compute_indicators(closes=prices), prices=prices,
+            errors=errors)
+    assert not worst_fields(errors=errors)
+
+
+def test_seeds_land_on_their_first_day():
+    prices = random_walk(random=Random(0), days=DAYS)
+    series = compute_indicators(closes=prices)
+    first_days = {field: int(np.argmax(~np.isnan(getattr(series, field))))
+                  for field in ('ema_short', 'ema_long', 'macd',
+                                'macd_signal', 'average_gains', 'rsi',
+                                'ema_big_long')}
+    assert first_days == {
+        'ema_short': MACD_SHORT_PERIOD - 1,
+        'ema_long': MACD_LONG_PERIOD - 1,
+        'macd': MACD_LONG_PERIOD - 1,
+        'macd_signal': MACD_LONG_PERIOD + MACD_SIGNAL_PERIOD - 1,
+        'average_gains': RSI_PERIOD,
+        'rsi': RSI_PERIOD,
+        'ema_big_long': EMA_BIG_LONG_PERIOD - 1}
+
+
+def test_short_history_is_all_nan():
+    series = compute_indicators(closes=[10.0] * (MACD_SHORT_PERIOD - 1))
+    for field in ('ema_short', 'ema_long', 'macd', 'macd_signal',
+                  'average_gains', 'rsi', 'ema_big_long'):
+        assert np.isnan(getattr(series, field)).all(), field
+
+
+@pytest.mark.parametrize('scenario', SCENARIOS)
+def test_update_stats_matches_reference(scenario: str):
+    errors = {}
+    for symbol, prices in cases(scenario=scenario):
+        reference = reference_documents(
+            symbol=symbol, prices=prices, dates=DATES)
+        # Daily incremental updates from the first stored day
+        asset = TrackedAsset.from_document(document=reference[0])
+        for expected, price, date in zip(
+                reference[1:], prices[INITIAL_DATA_POINTS + 1:],
+                DATES[INITIAL_DATA_POINTS + 1:]):
+            asset.update_stats(new_price=price, new_date=date)
+            compare_documents(
+                expected=expected, actual=asset.to_document(), errors=errors)
+    assert not worst_fields(errors=errors)